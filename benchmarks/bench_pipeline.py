@@ -0,0 +1,224 @@
+"""
+bench_pipeline.py: End-to-end benchmark of import, coalesce and summarize
+
+Runs each stage's command line program on fixtures from `make_fixtures.py`,
+each in its own subprocess, and reports for each stage:
+
+- seconds: wall time
+- peak_rss_mb: peak RSS of the stage's process, or of its largest worker
+- members_per_sec: GRIB members imported per second (import only)
+- rows_per_sec: rows read per second; for import, rows written
+- output_bytes: size of files the stage wrote
+
+Results are compared to a baseline JSON file, if one exists for the same
+fixtures and options, and stages that got slower or use more memory by more
+than `--tolerance` are reported as regressions, with a nonzero exit code.
+Baselines are only comparable on the same machine, so there is no baseline in
+the repo; create one with `--update-baseline` before making changes.
+
+I run this with:
+```
+python benchmarks/make_fixtures.py -o fixtures --days 2
+python benchmarks/bench_pipeline.py -f fixtures --update-baseline
+# ... make changes ...
+python benchmarks/bench_pipeline.py -f fixtures
+```
+"""
+import json
+import os
+import subprocess
+import sys
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+import click
+import pyarrow.parquet as pq
+
+CODE_DIR = Path(__file__).resolve().parents[1] / 'code'
+DEFAULT_BASELINE = Path(__file__).resolve().parent / 'baseline.json'
+
+# Metrics where larger values are worse, and are checked against the baseline
+CHECKED_METRICS = ['seconds', 'peak_rss_mb']
+
+
+@click.command()
+@click.option(
+    '-f',
+    '--fixtures-dir',
+    required=True,
+    type=click.Path(
+        exists=True, file_okay=False, dir_okay=True, resolve_path=True),
+    help='Directory written by make_fixtures.py.')
+@click.option(
+    '-w',
+    '--workers',
+    default=1,
+    show_default=True,
+    type=click.IntRange(min=1),
+    help='Number of processes for import and coalesce.')
+@click.option(
+    '--vsitar',
+    is_flag=True,
+    default=False,
+    help='Import with --vsitar.')
+@click.option(
+    '--baseline',
+    default=str(DEFAULT_BASELINE),
+    show_default=True,
+    type=click.Path(file_okay=True, dir_okay=False, resolve_path=True),
+    help='Baseline JSON file.')
+@click.option(
+    '--update-baseline',
+    is_flag=True,
+    default=False,
+    help='Save results as the new baseline instead of comparing to it.')
+@click.option(
+    '--tolerance',
+    default=.2,
+    show_default=True,
+    type=click.FloatRange(min=0),
+    help='Allowed relative increase of time and memory over the baseline.')
+@click.option(
+    '--keep-dir',
+    default=None,
+    type=click.Path(file_okay=False, dir_okay=True, resolve_path=True),
+    help='Write stage outputs here and keep them, instead of a temporary '
+    'directory.')
+def main(
+        fixtures_dir, workers, vsitar, baseline, update_baseline, tolerance,
+        keep_dir):
+    fixtures_dir = Path(fixtures_dir)
+    fixtures = json.loads((fixtures_dir / 'fixtures.json').read_text())
+    config = {'fixtures': fixtures, 'workers': workers, 'vsitar': vsitar}
+
+    with TemporaryDirectory() as tempdir:
+        work_dir = Path(keep_dir or tempdir)
+        stages = run_stages(fixtures_dir, fixtures, work_dir, workers, vsitar)
+
+    print_results(stages)
+    results = {'config': config, 'stages': stages}
+
+    baseline = Path(baseline)
+    if update_baseline:
+        baseline.write_text(json.dumps(results, indent=2))
+        print(f'Saved baseline to {baseline}')
+        return
+
+    if not baseline.exists():
+        print(f'No baseline at {baseline}; create one with --update-baseline')
+        return
+
+    base = json.loads(baseline.read_text())
+    if base['config'] != config:
+        print('Baseline is for different fixtures or options; not comparing')
+        return
+
+    regressions = compare(base['stages'], stages, tolerance)
+    if regressions:
+        sys.exit(1)
+
+
+def run_stages(fixtures_dir, fixtures, work_dir, workers, vsitar):
+    """Run import, coalesce and summarize in turn
+
+    Returns:
+        dict of metrics for each stage
+    """
+    grid_path = fixtures_dir / 'grid.geojson'
+    tar_paths = [str(fixtures_dir / name) for name in fixtures['tarballs']]
+    raw_dir = work_dir / 'raw'
+    coalesced_dir = work_dir / 'coalesced'
+    final_dir = work_dir / 'final'
+
+    stages = {}
+    cmd = [
+        'import.py', '-g', grid_path, '-d', raw_dir, '-w', workers, *tar_paths]
+    if vsitar:
+        cmd.append('--vsitar')
+    metrics = run_stage(cmd)
+    raw_rows = count_rows(raw_dir.glob('element=*/**/*.parquet'))
+    metrics['members_per_sec'] = fixtures['members'] / metrics['seconds']
+    metrics['rows_per_sec'] = raw_rows / metrics['seconds']
+    metrics['output_bytes'] = dir_size(raw_dir)
+    stages['import'] = metrics
+
+    metrics = run_stage([
+        'coalesce.py', '-d', raw_dir, '-o', coalesced_dir, '-w', workers])
+    metrics['rows_per_sec'] = raw_rows / metrics['seconds']
+    metrics['output_bytes'] = dir_size(coalesced_dir)
+    stages['coalesce'] = metrics
+
+    coalesced_rows = count_rows(coalesced_dir.glob('*.parquet'))
+    metrics = run_stage([
+        'summarize.py', '-g', grid_path, '-d', coalesced_dir, '-o',
+        final_dir])
+    metrics['rows_per_sec'] = coalesced_rows / metrics['seconds']
+    metrics['output_bytes'] = dir_size(final_dir)
+    stages['summarize'] = metrics
+
+    return stages
+
+
+def run_stage(cmd):
+    """Run a script of code/ in a subprocess
+
+    Returns:
+        dict with seconds and peak_rss_mb
+    """
+    cmd = [sys.executable, str(CODE_DIR / cmd[0]), *map(str, cmd[1:])]
+    start = perf_counter()
+    proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL)
+    # Peak RSS of the stage's process or any of its worker processes
+    _, status, rusage = os.wait4(proc.pid, 0)
+    seconds = perf_counter() - start
+    assert os.waitstatus_to_exitcode(status) == 0, f'{cmd[1]} failed'
+
+    # ru_maxrss is in kilobytes on Linux
+    return {'seconds': seconds, 'peak_rss_mb': rusage.ru_maxrss / 1024}
+
+
+def count_rows(paths):
+    return sum(pq.ParquetFile(p).metadata.num_rows for p in paths)
+
+
+def dir_size(path):
+    return sum(p.stat().st_size for p in Path(path).rglob('*') if p.is_file())
+
+
+def print_results(stages):
+    columns = [
+        'seconds', 'peak_rss_mb', 'members_per_sec', 'rows_per_sec',
+        'output_bytes']
+    print(f'{"stage":<10}' + ''.join(f'{c:>16}' for c in columns))
+    for name, metrics in stages.items():
+        values = [metrics.get(c) for c in columns]
+        print(f'{name:<10}' + ''.join(
+            f'{"-":>16}' if v is None else f'{v:>16,.1f}' for v in values))
+
+
+def compare(base_stages, stages, tolerance):
+    """Print change of each checked metric from baseline
+
+    Returns:
+        list of (stage, metric) that regressed by more than tolerance
+    """
+    regressions = []
+    for name, metrics in stages.items():
+        for metric in CHECKED_METRICS:
+            base = base_stages[name][metric]
+            ratio = metrics[metric] / base
+            flag = ''
+            if ratio > 1 + tolerance:
+                flag = '  REGRESSION'
+                regressions.append((name, metric))
+
+            print(
+                f'{name:<10}{metric:>12}: {base:10.1f} -> '
+                f'{metrics[metric]:10.1f} ({ratio - 1:+.0%}){flag}')
+
+    return regressions
+
+
+if __name__ == '__main__':
+    main()
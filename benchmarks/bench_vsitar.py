@@ -0,0 +1,111 @@
+"""
+bench_vsitar.py: Compare memory use of importing from bytes vs /vsitar/
+
+Imports the same tarball twice, each in its own subprocess. The first run
+copies each member into memory; the second opens members in place through
+GDAL's /vsitar/. Prints peak RSS and wall time of each run, and checks that
+both wrote the same data.
+
+I run this with:
+```
+python benchmarks/bench_vsitar.py -g grid.geojson -w 4 YEUZ98.tar
+```
+"""
+import importlib
+import os
+import subprocess
+import sys
+import tarfile
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+import click
+import geopandas as gpd
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / 'code'))
+import schema  # noqa: E402
+from writer import PartitionedWriter  # noqa: E402
+
+# import.py can't be imported with an import statement
+import_module = importlib.import_module('import')
+
+
+@click.command()
+@click.option(
+    '-g',
+    '--grid-path',
+    required=True,
+    type=click.Path(
+        exists=True, file_okay=True, dir_okay=False, resolve_path=True),
+    help='Path to grid GeoJSON file.')
+@click.option(
+    '-w',
+    '--workers',
+    default=1,
+    show_default=True,
+    type=click.IntRange(min=1),
+    help='Number of processes to use for decoding GRIB files')
+@click.option(
+    '--child',
+    type=click.Choice(['bytes', 'vsitar']),
+    default=None,
+    hidden=True,
+    help='Run a single import in this process')
+@click.option('--out-dir', default=None, hidden=True)
+@click.argument(
+    'tar_path',
+    type=click.Path(
+        exists=True, file_okay=True, dir_okay=False, resolve_path=True))
+def main(grid_path, workers, child, out_dir, tar_path):
+    if child is not None:
+        run_import(grid_path, workers, child, out_dir, tar_path)
+        return
+
+    with TemporaryDirectory() as tempdir:
+        out_dirs = {}
+        for mode in ['bytes', 'vsitar']:
+            out_dirs[mode] = Path(tempdir) / mode
+            cmd = [
+                sys.executable, __file__, '-g', grid_path, '-w',
+                str(workers), '--child', mode, '--out-dir',
+                str(out_dirs[mode]), tar_path]
+
+            start = perf_counter()
+            proc = subprocess.Popen(cmd)
+            # Peak RSS of the import process or any of its worker processes
+            _, status, rusage = os.wait4(proc.pid, 0)
+            elapsed = perf_counter() - start
+            assert os.waitstatus_to_exitcode(status) == 0, f'{mode} failed'
+
+            # ru_maxrss is in kilobytes on Linux
+            print(
+                f'{mode:>6}: {elapsed:8.2f} s, '
+                f'peak RSS {rusage.ru_maxrss / 1024:8.1f} MB')
+
+        a = load_sorted(out_dirs['bytes'])
+        b = load_sorted(out_dirs['vsitar'])
+        pd.testing.assert_frame_equal(a, b)
+        print(f'Outputs match ({len(a)} rows)')
+
+
+def run_import(grid_path, workers, mode, out_dir, tar_path):
+    """Import a single tarball, reading members as bytes or through /vsitar/
+    """
+    grid = gpd.read_file(grid_path)
+    with tarfile.open(tar_path) as tf, PartitionedWriter(out_dir) as writer:
+        import_module.import_tarfile(
+            tf=tf, grid=grid, writer=writer, workers=workers,
+            tar_path=tar_path if mode == 'vsitar' else None)
+
+
+def load_sorted(data_dir):
+    df = pd.concat([
+        schema.read_parquet(f)
+        for f in Path(data_dir).glob('element=*/**/*.parquet')])
+    return df.sort_values(schema.SORT_COLUMNS).reset_index(drop=True)
+
+
+if __name__ == '__main__':
+    main()
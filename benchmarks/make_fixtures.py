@@ -0,0 +1,203 @@
+"""
+make_fixtures.py: Write synthetic NDFD GRIB2 tarballs for benchmarking
+
+Writes one tarball per day, like the tarballs of a HAS extract, holding one
+GRIB2 member for each forecast element, reference hour and valid time. Members
+are written by GDAL's GRIB driver on the NDFD grid (`constants.crs` and
+`constants.aff`, or the 5km grid with `--grid 5km`), with forecast and valid
+times set, so `import.py` reads them exactly like real files. Values are a
+smooth field with some noise, in a plausible range for each element, packed
+with complex packing and spatial differencing as NDFD files are.
+
+Also writes `grid.geojson`, a long, thin diagonal grid of cells like a trail,
+and `fixtures.json` describing what was written.
+
+I run this with:
+```
+python benchmarks/make_fixtures.py -o fixtures --days 2
+```
+"""
+import json
+import sys
+import tarfile
+from datetime import datetime, timedelta
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+import click
+import numpy as np
+import rasterio
+import rasterio.shutil
+from rasterio.io import MemoryFile
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / 'code'))
+import constants  # noqa: E402
+import grids  # noqa: E402
+from get_grid import cells_to_gdf  # noqa: E402
+
+# Range of synthetic values, and GRIB parameter category and number, by
+# element
+ELEMENTS = {
+    'YEU': (250, 310, 0, 0),
+    'YGU': (260, 315, 0, 4),
+    'YHU': (245, 300, 0, 5),
+    'YDU': (0, 100, 1, 8),
+    'YIU': (0, 25, 1, 8),
+    'YCU': (0, 20, 2, 1),
+}
+
+
+@click.command()
+@click.option(
+    '-o',
+    '--out-dir',
+    required=True,
+    type=click.Path(file_okay=False, dir_okay=True, resolve_path=True),
+    help='Directory where to write fixtures.')
+@click.option(
+    '--start-date',
+    default='2017-01-01',
+    show_default=True,
+    type=str,
+    help='Date of first tarball.')
+@click.option(
+    '--days',
+    default=1,
+    show_default=True,
+    type=click.IntRange(min=1),
+    help='Number of daily tarballs.')
+@click.option(
+    '--elements',
+    default='YEU,YIU',
+    show_default=True,
+    type=str,
+    help='Comma-separated forecast elements.')
+@click.option(
+    '--hours',
+    default=24,
+    show_default=True,
+    type=click.IntRange(min=1, max=24),
+    help='Reference hours per day.')
+@click.option(
+    '--valid-times',
+    default=3,
+    show_default=True,
+    type=click.IntRange(min=1),
+    help='Members with different valid times per reference hour.')
+@click.option(
+    '--grid',
+    'grid_name',
+    default='2.5km',
+    show_default=True,
+    type=click.Choice([g.name for g in grids.GRIDS]),
+    help='NDFD grid of GRIB files.')
+@click.option(
+    '--cells',
+    default=2000,
+    show_default=True,
+    type=click.IntRange(min=1),
+    help='Approximate number of cells in grid.geojson.')
+@click.option(
+    '--seed', default=0, show_default=True, type=int, help='Random seed.')
+def main(
+        out_dir, start_date, days, elements, hours, valid_times, grid_name,
+        cells, seed):
+    out_dir = Path(out_dir)
+    out_dir.mkdir(exist_ok=True, parents=True)
+    grid = next(g for g in grids.GRIDS if g.name == grid_name)
+    elements = elements.split(',')
+    rng = np.random.default_rng(seed)
+
+    start = datetime.fromisoformat(start_date)
+    fields = {e: smooth_field(grid, e, rng) for e in elements}
+    tar_paths = []
+    n_members = 0
+    for day in range(days):
+        date = start + timedelta(days=day)
+        tar_path = out_dir / f'NDFD_{date:%Y%m%d}.tar'
+        with TemporaryDirectory() as tempdir, \
+                tarfile.open(tar_path, 'w') as tf:
+            for hour in range(hours):
+                ref_time = date + timedelta(hours=hour)
+                for element in elements:
+                    for i in range(valid_times):
+                        # Forecasts are for 1, 2, ... hours ahead. The minute
+                        # of the name keeps member names unique.
+                        name = f'{element}Z98_KWBN_{ref_time:%Y%m%d%H}{i:02d}'
+                        path = Path(tempdir) / name
+                        low, high, _, _ = ELEMENTS[element]
+                        arr = np.clip(
+                            fields[element] + rng.normal(0, .5), low, high)
+                        write_grib(path, grid, element, arr, ref_time, i + 1)
+                        tf.add(path, arcname=name)
+                        path.unlink()
+                        n_members += 1
+
+        tar_paths.append(tar_path.name)
+        print(f'Wrote {tar_path}')
+
+    gdf = cells_to_gdf(*trail_cells(cells))
+    (out_dir / 'grid.geojson').write_text(gdf.to_json())
+
+    meta = {
+        'tarballs': tar_paths,
+        'members': n_members,
+        'elements': elements,
+        'grid': grid_name,
+        'cells': cells,
+    }
+    (out_dir / 'fixtures.json').write_text(json.dumps(meta, indent=2))
+
+
+def smooth_field(grid, element, rng):
+    """Smooth field in the value range of element, with some noise
+    """
+    low, high, _, _ = ELEMENTS[element]
+    rows = np.linspace(0, 1, grid.height)[:, None]
+    cols = np.linspace(0, 1, grid.width)[None, :]
+    field = (
+        .5 + .3 * np.sin(6 * rows + rng.uniform(0, 6)) *
+        np.cos(4 * cols + rng.uniform(0, 6)) - .2 * rows)
+    field = field + rng.normal(0, .02, size=field.shape)
+    return (low + (high - low) * np.clip(field, 0, 1)).astype(np.float32)
+
+
+def write_grib(path, grid, element, arr, ref_time, forecast_hours):
+    """Write array as a GRIB2 file with given reference and valid time
+    """
+    _, _, category, number = ELEMENTS[element]
+    ids = (
+        'CENTER=8 SUBCENTER=0 MASTER_TABLE=2 SIGNF_REF_TIME=1 '
+        f'REF_TIME={ref_time:%Y-%m-%dT%H:%M:%S}Z PROD_STATUS=0 TYPE=1')
+    # Product definition template 4.0: parameter category and number,
+    # generating process, forecast time in hours, and surface
+    pds = (
+        f'{category} {number} 2 0 0 0 0 1 {forecast_hours} 1 0 0 255 0 0')
+
+    with MemoryFile() as memfile:
+        with memfile.open(
+                driver='GTiff', height=grid.height, width=grid.width,
+                count=1, dtype='float32', crs=constants.crs,
+                transform=grid.aff) as dataset:
+            dataset.write(arr, 1)
+
+        with memfile.open() as src, rasterio.Env():
+            rasterio.shutil.copy(
+                src, path, driver='GRIB', IDS=ids, PDS_PDTN=0,
+                PDS_TEMPLATE_ASSEMBLED_VALUES=pds,
+                DATA_ENCODING='COMPLEX_PACKING', SPATIAL_DIFFERENCING_ORDER=2,
+                DECIMAL_SCALE_FACTOR=1)
+
+
+def trail_cells(n):
+    """Grid cells of a diagonal, wandering line of n cells across the grid
+    """
+    t = np.linspace(0, 1, n)
+    x = (200 + 900 * t + 40 * np.sin(20 * t)).astype(np.int64)
+    y = (300 + 1500 * t).astype(np.int64)
+    cells = np.unique(np.column_stack([x, y]), axis=0)
+    return cells[:, 0], cells[:, 1]
+
+
+if __name__ == '__main__':
+    main()
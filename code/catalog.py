@@ -0,0 +1,202 @@
+"""
+catalog.py: Catalog of raw data files
+
+Listing directories and parsing paths of hundreds of thousands of raw files is
+slow, so `import.py` records each file it writes in a catalog inside the data
+directory, `data_dir/_catalog/*.parquet`. Every flush of the writer adds one
+small catalog fragment, so concurrent imports into the same directory don't
+conflict. Each row describes one raw data file:
+
+- path: path relative to data_dir
+- element: forecast code, e.g. YEU
+- year, month: partition of file, from forecast (reference) time
+- min_fcst_time, max_fcst_time: range of fcst_time in file, in minutes since
+  the epoch
+- size: bytes
+- num_rows
+
+For data directories written before the catalog existed, run:
+```
+python code/catalog.py data/raw
+```
+This catalogs files in the partitioned layout and in the older layout of one
+file per GRIB message, e.g. `YEUZ98_KWBN_201701010519.parquet`.
+"""
+import re
+import uuid
+from pathlib import Path
+
+import click
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+import schema
+
+CATALOG_DIR = '_catalog'
+COLUMNS = [
+    'path', 'element', 'year', 'month', 'min_fcst_time', 'max_fcst_time',
+    'size', 'num_rows']
+
+# Name of a file in the older layout of one file per GRIB message. Groups are
+# element, year, month, day, hour, minute of the forecast.
+MESSAGE_FILE_REGEX = (
+    r'^([A-Z]{3})Z98_[A-Z]{4}_(\d{4})(\d{2})(\d{2})(\d{2})(\d{2})')
+
+
+@click.command()
+@click.argument(
+    'data_dir',
+    type=click.Path(
+        exists=True, file_okay=False, dir_okay=True, resolve_path=True))
+def main(data_dir):
+    """Rebuild catalog of raw data directory"""
+    rebuild(data_dir)
+
+
+def entry(data_dir, path, element, year, month, table=None):
+    """Catalog row for written data file
+
+    Args:
+        - data_dir: root of data directory
+        - path: path of data file
+        - element, year, month: partition of data file
+        - table: optional pyarrow Table that was written to path, to avoid
+          reading it back
+    """
+    path = Path(path)
+    if table is None:
+        table = pq.read_table(path, columns=['fcst_time'])
+
+    fcst_time = table['fcst_time']
+    if pa.types.is_timestamp(fcst_time.type):
+        # Files in the older layout of one file per GRIB message have datetime
+        # columns
+        fcst_time = pa.array(schema.to_epoch_minutes(fcst_time.to_numpy()))
+
+    min_max = pc.min_max(fcst_time)
+    return {
+        'path': str(path.relative_to(data_dir)),
+        'element': element,
+        'year': year,
+        'month': month,
+        'min_fcst_time': min_max['min'].as_py(),
+        'max_fcst_time': min_max['max'].as_py(),
+        'size': path.stat().st_size,
+        'num_rows': table.num_rows,
+    }
+
+
+def append(data_dir, entries):
+    """Add catalog rows as a new catalog fragment
+    """
+    if not entries:
+        return
+
+    catalog_dir = Path(data_dir) / CATALOG_DIR
+    catalog_dir.mkdir(exist_ok=True, parents=True)
+    df = pd.DataFrame(entries, columns=COLUMNS)
+
+    path = catalog_dir / f'{uuid.uuid4().hex}.parquet'
+    with schema.atomic_path(path) as tmp_path:
+        df.to_parquet(tmp_path, index=False)
+
+
+def load(data_dir):
+    """Load catalog of data directory
+
+    Returns:
+        DataFrame with catalog columns, where `path` is absolute, or None if
+        the data directory has no catalog
+    """
+    catalog_dir = Path(data_dir) / CATALOG_DIR
+    fragments = sorted(catalog_dir.glob('*.parquet'))
+    if not fragments:
+        return None
+
+    df = pd.concat([pd.read_parquet(f) for f in fragments], ignore_index=True)
+    df['path'] = [str(Path(data_dir) / p) for p in df['path']]
+    return df
+
+
+def list_data_files(data_dir):
+    """Paths of all data files in data directory, of either layout
+
+    Catalog fragments, and temporary files of writes in progress, are skipped.
+    """
+    data_dir = Path(data_dir)
+    return [
+        f for f in data_dir.rglob('*.parquet')
+        if not any(
+            part.startswith(('_', '.'))
+            for part in f.relative_to(data_dir).parts)]
+
+
+def partition_of(path):
+    """Element, year and month of data file from its path
+
+    Returns:
+        (element, year, month), or None if path isn't of a data file
+    """
+    path = Path(path)
+    match = re.match(MESSAGE_FILE_REGEX, path.name)
+    if match:
+        element, year, month = match.groups()[:3]
+        return element, int(year), int(month)
+
+    parts = dict(
+        part.split('=', 1) for part in path.parent.parts[-3:] if '=' in part)
+    if not {'element', 'year', 'month'} <= parts.keys():
+        return None
+
+    return parts['element'], int(parts['year']), int(parts['month'])
+
+
+def rebuild(data_dir):
+    """Replace catalog with one created from listing data files
+    """
+    data_dir = Path(data_dir)
+    old_fragments = list((data_dir / CATALOG_DIR).glob('*.parquet'))
+
+    entries = []
+    for path in list_data_files(data_dir):
+        partition = partition_of(path)
+        if partition is None:
+            print(f'Skipping unrecognized data file path: {path}')
+            continue
+
+        entries.append(entry(data_dir, path, *partition))
+
+    # Remove old fragments only once the new one is written
+    append(data_dir, entries)
+    for fragment in old_fragments:
+        fragment.unlink()
+
+
+def time_filter(start_date=None, end_date=None):
+    """Dataset filter expression on fcst_time
+
+    Args:
+        - start_date: optional datetime-like of first forecast time to keep
+        - end_date: optional datetime-like of last forecast time to keep
+
+    Returns:
+        pyarrow.dataset Expression, or None if neither date is provided
+    """
+    expr = None
+    if start_date is not None:
+        start = int(schema.to_epoch_minutes([start_date])[0])
+        expr = ds.field('fcst_time') >= start
+
+    if end_date is not None:
+        end = int(schema.to_epoch_minutes([end_date])[0])
+        end_expr = ds.field('fcst_time') <= end
+        expr = end_expr if expr is None else expr & end_expr
+
+    return expr
+
+
+if __name__ == '__main__':
+    main()
@@ -12,22 +12,55 @@ script is for extracting just the most recent forecast for each valid time. This
 should then be one row per cell-forecast time, which should be able to be
 directly summarized off of.
 
-General idea:
-1. Load each month for each forecast element
-2. For each month:
-    1. Remove missing values, i.e. 9999 (is this the same missing value for all datasets?)
-    2. Take last forecast time for each valid_time within each x/y box
-    3. Save to temporary dataset
-3. Load all months for a single forecast element. Take last forecast time for
-each valid_time within each x/y box, save to final dataset.
+General idea, for each forecast element:
+1. Remove missing values, i.e. 9999 (is this the same missing value for all datasets?)
+2. Take last forecast time for each valid_time within each x/y box
+3. Save to final dataset
+
+Raw files are grouped by forecast element and month; each month is reduced on
+its own, and then the months of each element are merged. These tasks can run in
+a process pool with `--workers`.
+
+Each reduction is done with bounded memory by `reduce.coalesce_files`: when the
+data doesn't fit in the memory budget, it's first split into partitions by
+cell, and each partition is reduced separately.
+
+Raw files are found through the catalog that `import.py` maintains in each data
+directory (see `catalog.py`), falling back to listing the directory if there's
+no catalog. With `--list-files`, directories with a catalog are listed too,
+and files missing from their catalog are included. With `--element` and
+`--start-date`/`--end-date`, files of other elements and months, and files
+whose cataloged range of forecast times is outside the dates, are skipped. Rows
+outside the dates are filtered while reading, using parquet statistics to skip
+row groups.
+
+Next to each `<fcst_type>.parquet` output, a `<fcst_type>.manifest.json` records
+the raw files that went into it. With `--incremental`, only raw files not in the
+manifest are coalesced, and then merged into the existing output. The manifest
+also records `--start-date`/`--end-date`, since rows outside them were dropped
+from the output, and a later `--incremental` run recreates such an output from
+all raw files.
 """
+import json
 import re
-from itertools import chain
+from concurrent.futures import (
+    Executor, Future, ProcessPoolExecutor, as_completed)
 from pathlib import Path
 from tempfile import TemporaryDirectory
 
 import click
+import numpy as np
 import pandas as pd
+import pyarrow.parquet as pq
+from dateutil.parser import parse
+
+import catalog
+import metrics
+import schema
+from reduce import coalesce_files, latest_forecasts
+
+# Dates of a run that didn't filter raw rows
+NO_DATES = {'start_date': None, 'end_date': None}
 
 
 @click.command()
@@ -45,48 +78,340 @@ import pandas as pd
     required=True,
     type=click.Path(file_okay=False, dir_okay=True, resolve_path=True),
     help='Root of directory where to save extracted data.')
-def main(data_dir, out_dir):
-    # Create generator for file paths in each data_dir, and then chain them
-    # together to create a single iterator for all files across all provided
-    # data dirs
-    files = chain(*[d.iterdir() for d in data_dir])
-    names = create_file_names_df(files)
+@click.option(
+    '--memory-budget',
+    required=False,
+    default=2048,
+    show_default=True,
+    type=click.IntRange(min=1),
+    help='Approximate maximum memory to use, in MB.')
+@click.option(
+    '--incremental',
+    is_flag=True,
+    default=False,
+    help='Only coalesce raw files added since the last run.')
+@click.option(
+    '-w',
+    '--workers',
+    required=False,
+    default=1,
+    show_default=True,
+    type=click.IntRange(min=1),
+    help='Number of processes to use. Memory budget is shared between them.')
+@click.option(
+    '--element',
+    required=False,
+    multiple=True,
+    type=str,
+    help='Forecast element to coalesce, e.g. YEU. Default all.')
+@click.option(
+    '-s',
+    '--start-date',
+    required=False,
+    default=None,
+    type=str,
+    help='First forecast date to include')
+@click.option(
+    '-e',
+    '--end-date',
+    required=False,
+    default=None,
+    type=str,
+    help='Last forecast date to include')
+@click.option(
+    '--list-files',
+    is_flag=True,
+    default=False,
+    help='List data directories for files, even those with a catalog, and '
+    'include files missing from the catalog.')
+@click.option(
+    '--metrics-json',
+    required=False,
+    default=None,
+    type=click.Path(file_okay=True, dir_okay=False, resolve_path=True),
+    help='Write time spent in each stage and counts of files, bytes and rows '
+    'to this JSON file')
+def main(
+        data_dir, out_dir, memory_budget, incremental, workers, element,
+        start_date, end_date, list_files, metrics_json):
+    start_date = parse(start_date) if start_date is not None else None
+    end_date = parse(end_date) if end_date is not None else None
+    if incremental and (start_date is not None or end_date is not None):
+        raise click.UsageError(
+            '--incremental can\'t be used with --start-date or --end-date')
+
+    with metrics.timer('find_files'):
+        names = find_raw_files(data_dir, list_files=list_files)
+    names['month'] = names['date'].dt.to_period('M')
+
+    # Skip files of other elements and months
+    if element:
+        names = names[names['prefix'].isin(element)]
+    if start_date is not None:
+        names = names[names['month'].dt.end_time >= start_date]
+    if end_date is not None:
+        names = names[names['month'].dt.start_time <= end_date]
+
+    # Skip files whose cataloged range of fcst_time is outside the dates.
+    # Listed files have no range and are always read.
+    if start_date is not None:
+        start = schema.to_epoch_minutes([start_date])[0]
+        names = names[~(names['max_fcst_time'] < start)]
+    if end_date is not None:
+        end = schema.to_epoch_minutes([end_date])[0]
+        names = names[~(names['min_fcst_time'] > end)]
+    row_filter = catalog.time_filter(start_date, end_date)
+    dates = {
+        'start_date': str(start_date) if start_date is not None else None,
+        'end_date': str(end_date) if end_date is not None else None}
 
     # Create out_dir
     Path(out_dir).mkdir(exist_ok=True, parents=True)
 
-    # Find unique month periods for all files
-    months = names['date'].dt.to_period('M').unique()
-    # Find unique forecast types for all files
-    fcst_types = names['prefix'].unique()
+    jobs = []
+    with metrics.timer('plan'):
+        for fcst_type, matching in names.groupby('prefix'):
+            out_path = Path(out_dir) / (fcst_type.lower() + '.parquet')
+            job = ElementJob.plan(
+                matching, out_path, incremental=incremental, dates=dates)
+            if job is not None:
+                jobs.append(job)
+
+    # Each task running at once gets an even share of the memory budget
+    task_budget = memory_budget * 1024 ** 2 // workers
+    executor = SerialExecutor()
+    if workers > 1:
+        executor = ProcessPoolExecutor(max_workers=workers)
 
-    # Create generator to loop over product of months and fcst_types
-    for fcst_type in fcst_types:
-        # Will write each month temporarily into a temp directory, and then load
-        # them one last time at the end when creating a single file per fcst
-        # type
-        with TemporaryDirectory() as tempdir:
-            for month in months:
-                matching = names[(month.start_time <= names['date'])
-                                 & (names['date'] <= month.end_time)]
-                matching = matching[matching['prefix'] == fcst_type]
+    with executor, TemporaryDirectory() as tempdir:
+        run_jobs(
+            jobs, executor, Path(tempdir), task_budget, row_filter=row_filter)
 
-                if len(matching) <= 0:
-                    continue
+    if metrics_json:
+        metrics.write_json(metrics_json)
 
-                # Load the data files
-                data = load_files(matching['path'])
 
-                # Save to temp directory
-                path = Path(tempdir) / (str(month) + '.parquet')
-                data.to_parquet(path, index=False)
+def find_raw_files(data_dirs, list_files=False):
+    """Find raw data files in data directories
 
-            # Load all files in temp directory
-            combined_df = load_files(Path(tempdir).glob('*.parquet'))
+    Uses the catalog of each data directory if it has one, and otherwise
+    parses the paths of listed files.
 
-            # Write to out_dir
-            path = Path(out_dir) / (fcst_type.lower() + '.parquet')
-            combined_df.to_parquet(path, index=False)
+    Args:
+        - data_dirs: data directories
+        - list_files: if True, also list directories that have a catalog, and
+          include files missing from it, with a warning
+
+    Returns:
+        DataFrame with columns prefix, date and path, see
+        `create_file_names_df`, and min_fcst_time and max_fcst_time from the
+        catalog, NaN for listed files
+    """
+    dfs = []
+    listed = []
+    for data_dir in data_dirs:
+        df = catalog.load(data_dir)
+        if df is None:
+            listed.extend(catalog.list_data_files(data_dir))
+            continue
+
+        if list_files:
+            cataloged = set(df['path'])
+            missing = [
+                f for f in catalog.list_data_files(data_dir)
+                if str(f) not in cataloged]
+            if missing:
+                print(
+                    f'{len(missing)} data files in {data_dir} are not in its '
+                    f'catalog, e.g. {missing[0]}. Including them; run '
+                    f'`python code/catalog.py {data_dir}` to add them.')
+                listed.extend(missing)
+
+        dfs.append(pd.DataFrame({
+            'prefix': df['element'],
+            'date': pd.to_datetime(
+                pd.DataFrame({'year': df['year'], 'month': df['month'],
+                              'day': 1})),
+            'path': df['path'],
+            'min_fcst_time': df['min_fcst_time'],
+            'max_fcst_time': df['max_fcst_time'],
+        }))
+
+    if listed:
+        dfs.append(create_file_names_df(listed).assign(
+            min_fcst_time=np.nan, max_fcst_time=np.nan))
+
+    return pd.concat(dfs, ignore_index=True)
+
+
+class ElementJob:
+    """Raw files to coalesce for a single forecast element
+
+    Use `ElementJob.plan` to create.
+
+    Attributes:
+        - names: DataFrame of raw files to coalesce, with `path` and `month`
+          columns
+        - out_path: path of coalesced output file
+        - merge_existing: whether the existing output at out_path should be
+          merged with the newly coalesced files
+        - files: dict of size and modification time of all raw files of the
+          element, to be recorded in the manifest
+        - dates: dict of start_date and end_date that raw rows were filtered
+          to, None if not filtered, to be recorded in the manifest
+    """
+    def __init__(self, names, out_path, merge_existing, files, dates=None):
+        self.names = names
+        self.out_path = out_path
+        self.merge_existing = merge_existing
+        self.files = files
+        self.dates = dates or NO_DATES
+
+    @property
+    def manifest_path(self):
+        return self.out_path.with_suffix('.manifest.json')
+
+    @classmethod
+    def plan(cls, names, out_path, incremental=False, dates=None):
+        """Find raw files of forecast element that need to be coalesced
+
+        Args:
+            - names: DataFrame of all raw files of forecast element
+            - out_path: path of coalesced output file
+            - incremental: if True and a manifest of a previous run exists,
+              only coalesce files not in the manifest, and merge them into the
+              existing output. Rows are only replaced where a newer fcst_time
+              arrives.
+            - dates: dict of start_date and end_date that raw rows are
+              filtered to
+
+        Returns:
+            ElementJob, or None if there's nothing new to coalesce
+        """
+        out_path = Path(out_path)
+        files = {p: file_stat(p) for p in names['path']}
+        job = cls(
+            names, out_path, merge_existing=False, files=files, dates=dates)
+        if not (incremental and out_path.exists()
+                and job.manifest_path.exists()):
+            return job
+
+        with open(job.manifest_path) as f:
+            manifest = json.load(f)
+        old_files = manifest['files']
+
+        # Rows outside the dates of the previous run were never written, and
+        # would be missing for good if only new files were added
+        old_dates = manifest.get('dates', NO_DATES)
+        if old_dates != job.dates:
+            print(
+                f'Last run was limited to {old_dates}, recreating {out_path}')
+            return job
+
+        # Rows from a raw file that changed or disappeared can't be removed
+        # from the existing output
+        if any(files.get(p) != stat for p, stat in old_files.items()):
+            print(f'Raw files changed since last run, recreating {out_path}')
+            return job
+
+        new = names[~names['path'].isin(list(old_files))]
+        if len(new) == 0:
+            return None
+
+        return cls(
+            new, out_path, merge_existing=True, files=files, dates=dates)
+
+    def finish(self):
+        """Record manifest, once the output is in place
+        """
+        with schema.atomic_path(self.manifest_path) as tmp_path, \
+                open(tmp_path, 'w') as f:
+            json.dump({'files': self.files, 'dates': self.dates}, f)
+
+
+def run_jobs(jobs, executor, tempdir, memory_budget, row_filter=None):
+    """Coalesce each month of each job, then merge months of each job
+
+    Month tasks of all forecast elements run in executor at once, and each
+    element's merge starts as soon as its own months are done, so elements
+    don't wait on each other.
+
+    Args:
+        - jobs: list of ElementJob
+        - executor: concurrent.futures Executor to run tasks in
+        - tempdir: Path of directory for intermediate month files
+        - memory_budget: approximate maximum bytes of memory per task
+        - row_filter: optional pyarrow.dataset Expression selecting raw rows
+
+    Task time is recorded in `metrics` as `coalesce_months` and `merge`. With
+    several workers these add up time across processes.
+    """
+    month_futures = {}
+    month_paths = {}
+    remaining = {}
+    for i, job in enumerate(jobs):
+        month_paths[i] = []
+        for month, paths in job.names.groupby('month')['path']:
+            path = tempdir / f'{job.out_path.stem}_{month}.parquet'
+            metrics.count('raw_files', len(paths))
+            metrics.count('raw_bytes', sum(job.files[p][0] for p in paths))
+            future = executor.submit(
+                metrics.timed_call, coalesce_files, list(paths), path,
+                memory_budget=memory_budget, row_filter=row_filter)
+            month_futures[future] = i
+            month_paths[i].append(path)
+        remaining[i] = len(month_paths[i])
+
+    merge_futures = {}
+    for future in as_completed(month_futures):
+        _, seconds = future.result()
+        metrics.add_time('coalesce_months', seconds)
+        i = month_futures[future]
+        remaining[i] -= 1
+        if remaining[i] > 0:
+            continue
+
+        inputs = month_paths[i]
+        # The existing output goes last, so that it's kept when fcst_time is
+        # equal. It's only replaced once the merge is complete, so an
+        # interrupted run leaves it and its manifest intact.
+        if jobs[i].merge_existing:
+            inputs = inputs + [jobs[i].out_path]
+        future = executor.submit(
+            metrics.timed_call, coalesce_files, inputs, jobs[i].out_path,
+            memory_budget=memory_budget)
+        merge_futures[future] = i
+
+    for future in as_completed(merge_futures):
+        _, seconds = future.result()
+        metrics.add_time('merge', seconds)
+        i = merge_futures[future]
+        jobs[i].finish()
+        out_path = jobs[i].out_path
+        metrics.count(
+            'rows_written', pq.ParquetFile(out_path).metadata.num_rows)
+        metrics.count('bytes_written', out_path.stat().st_size)
+        for path in month_paths[i]:
+            path.unlink()
+
+
+class SerialExecutor(Executor):
+    """Executor that runs each task immediately in the calling process
+    """
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+
+def file_stat(path):
+    """Size and modification time of file, to detect changed files
+    """
+    stat = Path(path).stat()
+    return [stat.st_size, stat.st_mtime_ns]
 
 
 def load_files(paths):
@@ -96,24 +421,12 @@ def load_files(paths):
         - paths: file paths to data files
 
     Returns:
-        DataFrame: single DF with one row per x-y-valid_time combo. Same columns
-        as original files.
+        DataFrame: single DF with one row per cell-valid_time combo, in the
+        compact schema of `schema.py`.
     """
-    dfs = [pd.read_parquet(f) for f in paths]
+    dfs = [schema.read_parquet(f) for f in paths]
     df = pd.concat(dfs, sort=False)
-
-    # Remove missing values. It's 9999 in the max temp/YGU dataset, but not sure
-    # if it's that in all forecast elements
-    MISSING = 9999
-    df = df[df['vals'] != MISSING]
-
-    # Sort by 'x', 'y', 'valid_time', and then 'fcst_time'
-    df = df.sort_values(['x', 'y', 'valid_time', 'fcst_time'])
-    # Now within 'x', 'y', 'valid_time', take the last row. This should be the
-    # last fcst_time for each valid_time and x/y cell
-    df = df.drop_duplicates(['x', 'y', 'valid_time'], keep='last')
-
-    return df
+    return latest_forecasts(df)
 
 
 def create_file_names_df(files):
@@ -121,21 +434,25 @@ def create_file_names_df(files):
 
     Given a list of files, create a DataFrame with columns:
     - prefix: forecast code, e.g. YEU
-    - year
-    - month
-    - day
-    - hour
-    - minute
+    - date
     - path
 
-    Note that these dates come from the filename, so they should not be
-    considered exact.
+    Files are either in the partitioned layout written by `import.py`, i.e.
+    `element=YEU/year=2017/month=01/part-*.parquet`, or in the older layout of
+    one file per GRIB message, e.g. `YEUZ98_KWBN_201701010519.parquet`.
+
+    Note that these dates come from the file path, so they should not be
+    considered exact. For partitioned files, the date is the start of the
+    month.
     """
-    regex = r'^([A-Z]{3})Z98_[A-Z]{4}_(\d{4})(\d{2})(\d{2})(\d{2})(\d{2})'
     # groups: prefix, year, month, day, hour, minute
     all_rows = []
     for file in files:
-        row = list(re.match(regex, file.name).groups())
+        match = re.match(catalog.MESSAGE_FILE_REGEX, file.name)
+        if match:
+            row = list(match.groups())
+        else:
+            row = parse_partition_path(file)
         row.append(str(file))
         all_rows.append(row)
 
@@ -157,5 +474,15 @@ def create_file_names_df(files):
     return names
 
 
+def parse_partition_path(file):
+    """Get prefix, year, month, day, hour, minute from hive-partitioned path
+    """
+    partition = catalog.partition_of(file)
+    msg = f'Unrecognized data file path: {file}'
+    assert partition is not None, msg
+    element, year, month = partition
+    return [element, year, month, 1, 0, 0]
+
+
 if __name__ == '__main__':
     main()
@@ -14,3 +14,13 @@ d = 0
 e = -2539.70
 f = 3232111.71
 aff = Affine(a, b, c, d, e, f)
+
+# Shape of the 2.5km CONUS grid
+height = 1377
+width = 2145
+
+# 5km CONUS grid, used through August 2014. It has the same projection and
+# lower left cell center as the 2.5km grid, with cells twice as large.
+aff_5km = Affine(5079.406, 0, -2765744.20, 0, -5079.406, 3233381.56)
+height_5km = 689
+width_5km = 1073
@@ -0,0 +1,235 @@
+"""
+cube.py: Memory-mapped cube of summary statistics, queried by geometry
+
+`summarize.py` writes all statistics of all forecast elements into a single
+dense float32 array of shape (cell, half-month, element, stat), so that every
+statistic of a cell is stored contiguously. A cube directory holds:
+
+- `cube.npy`: the statistics
+- `cells.npy`: sorted cell ids, for the first axis of the cube
+- `meta.json`: names of elements and stats, for the third and fourth axes
+
+Statistics an element doesn't have, e.g. precipitation exceedance of
+temperature, are NaN, and so are all statistics but `count` of half-months
+without values.
+
+The cube is opened with `np.load(mmap_mode='r')`, so nothing is read until a
+query touches it, and a point query only reads the pages of one cell:
+
+```py
+from cube import Cube
+
+cube = Cube('data/final/cube')
+values = cube.point(-119.5, 37.8)
+mean_temp = values[:, cube.elements.index('yeu'), cube.stats.index('mean')]
+df = cube.to_df(*cube.bbox(-120.5, 37.9, -119.6, 38.8))
+```
+"""
+import json
+from functools import lru_cache
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import shapely
+from pyproj import Transformer
+
+import constants
+import get_grid
+import schema
+from stats import N_BINS, CellIndex
+
+
+def write(path, cells, stats_by_element):
+    """Write cube of summary statistics
+
+    Args:
+        - path: cube directory
+        - cells: cell ids, in the order of the first axis of stats arrays
+        - stats_by_element: dict of {element: {stat: array}}, with arrays of
+          shape (n_cells, N_BINS), e.g. from `summarize.element_stats`
+    """
+    path = Path(path)
+    path.mkdir(exist_ok=True, parents=True)
+
+    elements = sorted(stats_by_element)
+    stats = []
+    for element in elements:
+        stats.extend(s for s in stats_by_element[element] if s not in stats)
+
+    cells = np.asarray(cells, dtype=np.int32)
+    order = np.argsort(cells)
+
+    # Files are only renamed into place once all of them are written, so that
+    # a reader never opens a partially written cube
+    with schema.atomic_path(path / 'cube.npy') as cube_path, \
+            schema.atomic_path(path / 'cells.npy') as cells_path, \
+            schema.atomic_path(path / 'meta.json') as meta_path:
+        arr = np.lib.format.open_memmap(
+            cube_path, mode='w+', dtype=np.float32,
+            shape=(len(cells), N_BINS, len(elements), len(stats)))
+        arr[:] = np.nan
+        for i, element in enumerate(elements):
+            element_stats = stats_by_element[element]
+            # Accumulators start at 0, e.g. the mean of Moments, so only
+            # keep statistics where there are values
+            empty = element_stats['count'][order] == 0
+            for name, values in element_stats.items():
+                values = values[order]
+                if name != 'count':
+                    values = np.where(empty, np.nan, values)
+                arr[:, :, i, stats.index(name)] = values
+        arr.flush()
+        del arr
+
+        # np.save would add .npy to a path without that suffix
+        with open(cells_path, 'wb') as f:
+            np.save(f, cells[order])
+        meta = {'elements': elements, 'stats': stats, 'n_bins': N_BINS}
+        meta_path.write_text(json.dumps(meta, indent=2))
+
+
+class Cube:
+    """Read-only summary statistics cube
+
+    Args:
+        - path: cube directory written by `write`
+
+    Attributes:
+        - cells: sorted cell ids in the cube
+        - elements: element names, for the third axis of results
+        - stats: statistic names, for the fourth axis of results
+        - data: memory-mapped array of shape (cell, half-month, element, stat)
+    """
+    def __init__(self, path):
+        path = Path(path)
+        meta = json.loads((path / 'meta.json').read_text())
+        self.elements = meta['elements']
+        self.stats = meta['stats']
+        self.data = np.load(path / 'cube.npy', mmap_mode='r')
+        self._index = CellIndex(np.load(path / 'cells.npy'))
+        self.cells = self._index.cells
+
+    def cell_stats(self, cells):
+        """Statistics of cells
+
+        Returns:
+            array of shape (n_cells, N_BINS, n_elements, n_stats); NaN for
+            cells not in the cube
+        """
+        idx = self._index.lookup(np.asarray(cells, dtype=np.int64))
+        out = np.asarray(self.data[np.maximum(idx, 0)], dtype=np.float32)
+        out[idx < 0] = np.nan
+        return out
+
+    def point(self, lon, lat):
+        """Statistics of the cell containing a point
+
+        Returns:
+            array of shape (N_BINS, n_elements, n_stats), or None if the cell
+            isn't in the cube
+        """
+        x, y = _to_grid().transform(lon, lat)
+        cell = grid_cells(np.array([x]), np.array([y]))[0]
+        if cell < 0:
+            return None
+
+        idx = self._index.lookup(np.array([cell]))[0]
+        if idx < 0:
+            return None
+
+        return np.asarray(self.data[idx])
+
+    def line(self, geometry):
+        """Statistics of cells crossed by a LineString in WGS84
+
+        The line is projected to the NDFD grid, and every cell crossed by one
+        of its segments is found with `get_grid.line_cells`.
+
+        Args:
+            - geometry: shapely LineString or MultiLineString
+
+        Returns:
+            (cells, array of shape (n_cells, N_BINS, n_elements, n_stats)) of
+            cells in the cube, in order of cell id
+        """
+        projected = shapely.transform(
+            geometry,
+            lambda c: np.column_stack(_to_grid().transform(c[:, 0], c[:, 1])))
+        cells = get_grid.line_cells(np.array([projected]))
+
+        inside = _inside_grid(cells[:, 0], cells[:, 1])
+        cells = schema.cell_id(cells[inside, 0], cells[inside, 1])
+        return self._select(np.unique(cells))
+
+    def bbox(self, minx, miny, maxx, maxy):
+        """Statistics of cells whose center is within a WGS84 bounding box
+
+        Returns:
+            (cells, array of shape (n_cells, N_BINS, n_elements, n_stats)), in
+            order of cell id
+        """
+        lon, lat = self._centers()
+        keep = (lon >= minx) & (lon <= maxx) & (lat >= miny) & (lat <= maxy)
+        cells = self.cells[keep]
+        return cells, np.asarray(self.data[np.flatnonzero(keep)])
+
+    def to_df(self, cells, values):
+        """Long DataFrame of statistics returned by a query
+
+        Returns:
+            DataFrame with columns x, y, month_half, element, and one column
+            per statistic. Rows without data are dropped.
+        """
+        n_elements = len(self.elements)
+        n = len(cells) * N_BINS * n_elements
+        x, y = schema.cell_xy(cells)
+        df = pd.DataFrame({
+            'x': np.repeat(x, N_BINS * n_elements),
+            'y': np.repeat(y, N_BINS * n_elements),
+            'month_half': np.tile(
+                np.repeat(np.arange(1, N_BINS + 1), n_elements), len(cells)),
+            'element': np.tile(self.elements, len(cells) * N_BINS),
+        })
+        values = np.asarray(values).reshape(n, len(self.stats))
+        for i, name in enumerate(self.stats):
+            df[name] = values[:, i]
+
+        return df[df['count'] > 0].reset_index(drop=True)
+
+    def _select(self, cells):
+        idx = self._index.lookup(cells)
+        keep = idx >= 0
+        return cells[keep], np.asarray(self.data[idx[keep]])
+
+    def _centers(self):
+        """WGS84 coordinates of centers of cube cells
+        """
+        if not hasattr(self, '_center_coords'):
+            px, py = get_grid.cell_centers(*schema.cell_xy(self.cells))
+            self._center_coords = _to_grid().transform(
+                px, py, direction='INVERSE')
+
+        return self._center_coords
+
+
+def grid_cells(px, py):
+    """Cell ids of projected NDFD coordinates, or -1 outside of the grid
+    """
+    x, y = get_grid.grid_index(px, py)
+    inside = _inside_grid(x, y)
+    return np.where(inside, schema.cell_id(x, y), -1)
+
+
+def _inside_grid(x, y):
+    return (
+        (x >= 0) & (x < constants.height) & (y >= 0) & (y < constants.width))
+
+
+@lru_cache()
+def _to_grid():
+    """Transformer from WGS84 to NDFD grid projection
+
+    Creating a Transformer takes milliseconds, so it's only done once.
+    """
+    return Transformer.from_crs('EPSG:4326', constants.crs, always_xy=True)
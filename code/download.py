@@ -0,0 +1,230 @@
+"""
+download.py: Download NDFD tarballs
+
+The NOAA HAS server is slow, so downloads can be resumed with HTTP Range
+requests, and upcoming tarballs can be prefetched in background threads while
+the current one is being imported.
+"""
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from pathlib import Path
+from threading import Event
+from time import sleep
+from urllib.error import HTTPError, URLError
+from urllib.request import Request, urlopen
+
+from tqdm import tqdm
+
+CHUNK_SIZE = 1024 * 1024
+
+
+class DownloadCancelled(Exception):
+    pass
+
+
+class DownloadProgressBar(tqdm):
+    def update_to(self, b=1, bsize=1, tsize=None):
+        if tsize is not None:
+            self.total = tsize
+        self.update(b * bsize - self.n)
+
+
+def download_url(url, output_path, retries=5, stop=None):
+    """Download url to output_path
+
+    If output_path already exists, it's assumed to be a partial download and
+    only the remaining bytes are requested. Dropped connections, timeouts and
+    5xx or 429 responses are retried, continuing from the last byte written.
+    Other HTTP errors, e.g. 404, are raised right away.
+
+    Args:
+        - stop: optional threading.Event. Once set, the download stops after
+          the current chunk, keeping the partial file, and DownloadCancelled
+          is raised.
+    """
+    output_path = Path(output_path)
+    for attempt in range(retries + 1):
+        try:
+            _download_remaining(url, output_path, stop)
+            return
+        except (URLError, ConnectionError, TimeoutError) as e:
+            # HTTPError is a URLError too, but only server errors and rate
+            # limiting are worth retrying
+            if isinstance(e, HTTPError) and not _is_transient(e.code):
+                raise
+            if attempt == retries:
+                raise
+            print(f'Download of {url} failed, resuming: {e}')
+            sleep(2 ** attempt)
+
+
+def _is_transient(status):
+    return status >= 500 or status == 429
+
+
+def _download_remaining(url, output_path, stop=None):
+    offset = output_path.stat().st_size if output_path.exists() else 0
+
+    req = Request(url)
+    if offset > 0:
+        req.add_header('Range', f'bytes={offset}-')
+
+    try:
+        res = urlopen(req)
+    except HTTPError as e:
+        # Range starts at or after end of file, i.e. download was complete
+        if e.code == 416 and offset > 0:
+            return
+        raise
+
+    with res:
+        # Server ignored the Range header; start from scratch
+        if offset > 0 and res.status != 206:
+            offset = 0
+
+        total = res.headers.get('Content-Length')
+        total = int(total) + offset if total is not None else None
+
+        mode = 'ab' if offset > 0 else 'wb'
+        with DownloadProgressBar(unit='B', unit_scale=True, miniters=1,
+                                 total=total, initial=offset,
+                                 desc=url.split('/')[-1]) as t, open(
+                                     output_path, mode) as f:
+            while True:
+                if stop is not None and stop.is_set():
+                    raise DownloadCancelled(url)
+
+                chunk = res.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                f.write(chunk)
+                t.update(len(chunk))
+
+
+def content_length(url):
+    """Size in bytes of url, from a HEAD request, or None if not reported
+    """
+    with urlopen(Request(url, method='HEAD')) as res:
+        length = res.headers.get('Content-Length')
+
+    return int(length) if length is not None else None
+
+
+@contextmanager
+def open_url_stream(url):
+    """Open url as a file-like object, updating a progress bar as it is read
+    """
+    with urlopen(url) as res:
+        total = res.headers.get('Content-Length')
+        total = int(total) if total is not None else None
+        with DownloadProgressBar.wrapattr(
+                res, 'read', total=total, miniters=1,
+                desc=url.split('/')[-1]) as wrapped:
+            yield wrapped
+
+
+class Prefetcher:
+    """Iterate over downloaded tarballs while downloading the next ones
+
+    Iterating yields `(url, local_path)` in the order of `urls`. While the
+    consumer works on one tarball, up to `prefetch` of the following tarballs
+    are downloaded in background threads. Each file is deleted once the
+    consumer asks for the next one.
+
+    Args:
+        - urls: tarball urls
+        - dirpath: directory to download into. Partial downloads left in this
+          directory from an earlier run are resumed.
+        - prefetch: number of tarballs to download ahead of the current one
+        - max_bytes: if provided, a new download is only started when the
+          tarballs on disk or being downloaded, including the current one,
+          would total no more than this many bytes. One tarball is always
+          allowed, even if it alone is larger. Tarballs whose size can't be
+          found count as 0 bytes.
+        - on_error: optional function called with (url, exception) when a
+          download fails, after which that tarball is skipped. Without it,
+          the exception is raised.
+
+    When iteration stops early, e.g. on Ctrl-C, downloads in progress are
+    stopped after their current chunk instead of run to completion. Their
+    partial files are left to be resumed.
+    """
+    def __init__(
+            self, urls, dirpath, prefetch=0, max_bytes=None, on_error=None):
+        self.urls = list(urls)
+        self.dirpath = Path(dirpath)
+        self.prefetch = prefetch
+        self.max_bytes = max_bytes
+        self.on_error = on_error
+        # Sizes from HEAD requests by url, so that each url is only requested
+        # once while the disk budget holds back its download
+        self._sizes = {}
+
+    def __iter__(self):
+        urls = deque(self.urls)
+        # Items of (url, local_path, size, future)
+        pending = deque()
+        stop = Event()
+        executor = ThreadPoolExecutor(max_workers=max(self.prefetch, 1))
+        try:
+            while urls or pending:
+                if not pending:
+                    self._schedule(executor, urls, pending, stop)
+
+                current = pending.popleft()
+                # Start the next downloads before waiting on the current one
+                self._schedule(executor, urls, pending, stop, current=current)
+
+                url, local_path, _, future = current
+                try:
+                    future.result()
+                except Exception as e:
+                    if self.on_error is None:
+                        raise
+                    # The partial file is kept, to be resumed by a rerun
+                    self.on_error(url, e)
+                    continue
+
+                try:
+                    yield url, local_path
+                finally:
+                    local_path.unlink(missing_ok=True)
+        finally:
+            stop.set()
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def _schedule(self, executor, urls, pending, stop, current=None):
+        """Start downloads until prefetch count or disk budget is reached
+
+        `current` is the item held by the consumer, if any.
+        """
+        held = list(pending) if current is None else [current, *pending]
+        # Without a current item, only the next tarball is needed
+        limit = 1 if current is None else 1 + self.prefetch
+        used = sum(item[2] or 0 for item in held)
+
+        while urls and len(held) < limit:
+            size = None
+            if self.max_bytes is not None:
+                size = self._size(urls[0])
+                if held and used + (size or 0) > self.max_bytes:
+                    break
+
+            url = urls.popleft()
+            local_path = self.dirpath / Path(url).name
+            future = executor.submit(download_url, url, local_path, stop=stop)
+            item = (url, local_path, size, future)
+            pending.append(item)
+            held.append(item)
+            used += size or 0
+
+    def _size(self, url):
+        if url not in self._sizes:
+            try:
+                self._sizes[url] = content_length(url)
+            except (URLError, ConnectionError, TimeoutError) as e:
+                print(f'Could not find size of {url}: {e}')
+                self._sizes[url] = None
+
+        return self._sizes[url]
@@ -0,0 +1,266 @@
+"""
+elevation.py: Look up elevations of grid cells from the NWS API
+
+The elevation of a point is only included in the forecast output of the NWS
+API, so each cell takes two requests: one to `/points/{lat},{lon}` to find the
+forecast url, and one to the forecast itself. Requests for many cells are made
+concurrently over a pooled connection, limited to a given rate, and retried
+with exponential backoff on rate limiting, server errors and timeouts.
+
+Results are cached in a SQLite database keyed by NDFD grid cell (x, y), so
+reruns only request cells that haven't been looked up yet. Points outside the
+US return 404; those are cached as missing too.
+
+```py
+from elevation import get_elevations
+
+ele = get_elevations(x, y, lon, lat, cache_path='elevations.sqlite')
+```
+"""
+import asyncio
+import sqlite3
+import time
+from pathlib import Path
+
+import aiohttp
+import numpy as np
+
+import metrics
+
+API_URL = 'https://api.weather.gov'
+HEADERS = {
+    'accept': 'application/geo+json',
+    'user-agent':
+    'ndfd_historical (https://github.com/nst-guide/ndfd_historical)',
+}
+DEFAULT_CACHE_PATH = (
+    Path.home() / '.cache' / 'ndfd_historical' / 'elevations.sqlite')
+
+# Statuses worth retrying: rate limited, or temporary server errors
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+def get_elevations(
+        x, y, lon, lat, api_url=API_URL, rate=10, concurrency=8,
+        cache_path=DEFAULT_CACHE_PATH, retries=5):
+    """Elevations of grid cells in meters
+
+    Args:
+        - x, y: NDFD grid indices of cells, used as cache keys
+        - lon, lat: WGS84 coordinates to look up, e.g. cell centroids
+        - api_url: root of NWS API
+        - rate: maximum requests per second
+        - concurrency: maximum requests in flight at once
+        - cache_path: SQLite cache file, or None to not cache
+        - retries: number of times to retry a failed request
+
+    Returns:
+        array of elevations, NaN where the API has no forecast for a point
+    """
+    cells = list(zip(
+        np.asarray(x).tolist(), np.asarray(y).tolist(),
+        np.asarray(lon).tolist(), np.asarray(lat).tolist()))
+    cache = ElevationCache(cache_path)
+    try:
+        return asyncio.run(fetch_elevations(
+            cells, cache, api_url=api_url, rate=rate, concurrency=concurrency,
+            retries=retries))
+    finally:
+        cache.close()
+
+
+async def fetch_elevations(
+        cells, cache, api_url=API_URL, rate=10, concurrency=8, retries=5):
+    """Elevations of cells, from cache or requested concurrently
+
+    Args:
+        - cells: list of (x, y, lon, lat)
+        - cache: ElevationCache
+        - others: see `get_elevations`
+
+    Returns:
+        array of elevations, in the order of cells
+    """
+    cached = cache.get_many([(x, y) for x, y, _, _ in cells])
+    elevations = np.full(len(cells), np.nan)
+    missing = []
+    for i, (x, y, lon, lat) in enumerate(cells):
+        if (x, y) in cached:
+            elevations[i] = cached[(x, y)]
+        else:
+            missing.append(i)
+
+    metrics.count('elevation_cache_hits', len(cells) - len(missing))
+    metrics.count('elevation_lookups', len(missing))
+    if not missing:
+        return elevations
+
+    limiter = RateLimiter(rate)
+    semaphore = asyncio.Semaphore(concurrency)
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    timeout = aiohttp.ClientTimeout(total=30)
+
+    async with aiohttp.ClientSession(
+            connector=connector, timeout=timeout, headers=HEADERS) as session:
+
+        async def lookup(i):
+            x, y, lon, lat = cells[i]
+            async with semaphore:
+                ele = await point_elevation(
+                    session, limiter, api_url, lon, lat, retries=retries)
+            cache.put(x, y, ele)
+            elevations[i] = ele
+
+        await asyncio.gather(*(lookup(i) for i in missing))
+
+    cache.commit()
+    return elevations
+
+
+async def point_elevation(session, limiter, api_url, lon, lat, retries=5):
+    """Elevation in meters of a point, or NaN if the API has no forecast there
+    """
+    url = f'{api_url}/points/{lat:.4f},{lon:.4f}'
+    # Points in Mexico/Canada return 404
+    point = await fetch_json(session, limiter, url, retries=retries)
+    if point is None:
+        return np.nan
+
+    forecast_url = point['properties'].get('forecast')
+    if forecast_url is None:
+        return np.nan
+
+    forecast = await fetch_json(
+        session, limiter, forecast_url, retries=retries)
+    if forecast is None:
+        return np.nan
+
+    ele = forecast['properties']['elevation']
+    msg = 'Elevation not in meters'
+    assert ele['unitCode'] in ('unit:m', 'wmoUnit:m'), msg
+    # The API gives a null value for some forecast points
+    if ele['value'] is None:
+        return np.nan
+
+    return ele['value']
+
+
+async def fetch_json(session, limiter, url, retries=5):
+    """GET url as JSON, retrying with exponential backoff
+
+    Returns:
+        parsed JSON, or None if the url returns 404
+    """
+    for attempt in range(retries + 1):
+        await limiter.acquire()
+        metrics.count('api_requests')
+        try:
+            async with session.get(url) as res:
+                if res.status == 404:
+                    return None
+
+                if res.status not in RETRY_STATUSES:
+                    res.raise_for_status()
+                    return await res.json(content_type=None)
+
+                retry_after = res.headers.get('retry-after')
+                error = aiohttp.ClientResponseError(
+                    res.request_info, res.history, status=res.status)
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+            retry_after = None
+            error = e
+
+        if attempt == retries:
+            raise error
+
+        metrics.count('api_retries')
+        delay = 2 ** attempt * .5
+        if retry_after is not None and retry_after.isdigit():
+            delay = max(delay, int(retry_after))
+        await asyncio.sleep(delay)
+
+
+class RateLimiter:
+    """Token bucket limiting requests to `rate` per second, with bursts of up
+    to `burst` requests
+
+    Args:
+        - rate: requests per second
+        - burst: bucket size. Default is one second of requests.
+    """
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or max(rate, 1)
+        self._tokens = self.burst
+        self._last = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(
+                    self.burst, self._tokens + (now - self._last) * self.rate)
+                self._last = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class ElevationCache:
+    """SQLite cache of elevations keyed by NDFD grid cell (x, y)
+
+    Missing elevations, i.e. points outside the US, are stored as NULL.
+
+    Args:
+        - path: SQLite file, created if it doesn't exist. If None, nothing is
+          cached.
+    """
+    def __init__(self, path):
+        self.conn = None
+        if path is None:
+            return
+
+        Path(path).parent.mkdir(exist_ok=True, parents=True)
+        self.conn = sqlite3.connect(path)
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS elevations '
+            '(x INTEGER, y INTEGER, ele REAL, PRIMARY KEY (x, y))')
+
+    def get_many(self, keys):
+        """Cached elevations of (x, y) keys, as a dict of only those cached
+        """
+        if self.conn is None:
+            return {}
+
+        found = {}
+        self.conn.execute(
+            'CREATE TEMP TABLE IF NOT EXISTS lookup (x INTEGER, y INTEGER)')
+        self.conn.execute('DELETE FROM lookup')
+        self.conn.executemany('INSERT INTO lookup VALUES (?, ?)', keys)
+        rows = self.conn.execute(
+            'SELECT e.x, e.y, e.ele FROM elevations e '
+            'JOIN lookup l ON e.x = l.x AND e.y = l.y')
+        for x, y, ele in rows:
+            found[(x, y)] = np.nan if ele is None else ele
+
+        return found
+
+    def put(self, x, y, ele):
+        if self.conn is None:
+            return
+
+        ele = None if np.isnan(ele) else float(ele)
+        self.conn.execute(
+            'INSERT OR REPLACE INTO elevations VALUES (?, ?, ?)', (x, y, ele))
+
+    def commit(self):
+        if self.conn is not None:
+            self.conn.commit()
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.commit()
+            self.conn.close()
@@ -1,35 +1,80 @@
-import os.path
 import re
-import tempfile
-from time import sleep
 
 import click
 import geopandas as gpd
 import numpy as np
 import pandas as pd
-import rasterio
-import rasterio.mask
-import requests
+import rasterio.features
+import rasterio.transform
+import rasterio.windows
+import shapely
 from shapely.geometry import box
 
 import constants
+import elevation
+import metrics
 
 
-# If you wanted to do bbox, you could get the cells of the four corners, and then include everything between them
-# Something similar for polygons? Where you query all the cells of the exterior,
-# and assume that inner cells are included. (I.e. no polygons with holes.)
 @click.command()
 @click.option(
     '--bbox',
     required=False,
     default=None,
     type=str,
-    help='Bounding box to use for finding grid intersections.')
+    help='Bounding box to use for finding grid intersections, as '
+    'minx,miny,maxx,maxy in WGS84.')
+@click.option(
+    '--all-touched',
+    is_flag=True,
+    default=False,
+    help='Include every cell touched by a polygon or bbox, instead of only '
+    'cells whose center is inside it.')
+@click.option(
+    '--supercover',
+    is_flag=True,
+    default=False,
+    help='Include every cell that line segments cross, instead of only cells '
+    'of line vertices.')
+@click.option(
+    '--buffer-cells',
+    required=False,
+    default=0,
+    show_default=True,
+    type=click.IntRange(min=0),
+    help='Also include cells within this many cells of intersected cells.')
 @click.option(
     '--elevations',
     is_flag=True,
     default=False,
     help='Whether to ping NWS API for elevations of each grid square.')
+@click.option(
+    '--elevation-cache',
+    required=False,
+    default=None,
+    type=click.Path(file_okay=True, dir_okay=False, resolve_path=True),
+    help='SQLite file where to cache elevations of grid squares. Default: '
+    '~/.cache/ndfd_historical/elevations.sqlite')
+@click.option(
+    '--api-url',
+    required=False,
+    default=elevation.API_URL,
+    show_default=True,
+    type=str,
+    help='Root url of NWS API.')
+@click.option(
+    '--rate',
+    required=False,
+    default=10,
+    show_default=True,
+    type=click.FloatRange(min=0, min_open=True),
+    help='Maximum requests per second to NWS API.')
+@click.option(
+    '--metrics-json',
+    required=False,
+    default=None,
+    type=click.Path(file_okay=True, dir_okay=False, resolve_path=True),
+    help='Write time spent in each stage and counts of geometries, cells and '
+    'API requests to this JSON file.')
 @click.argument(
     'file',
     required=False,
@@ -37,150 +82,290 @@ import constants
     type=click.Path(
         exists=True, file_okay=True, dir_okay=False, resolve_path=True),
     default=None)
-def main(bbox, elevations, file):
-    if (bbox is None) and (file is None):
+def main(
+        bbox, all_touched, supercover, buffer_cells, elevations,
+        elevation_cache, api_url, rate, metrics_json, file):
+    # click gives an empty tuple when no files are passed
+    if (bbox is None) and (not file):
         raise ValueError('Either bbox or file must be provided')
 
-    if (bbox is not None) and (file is not None):
+    if (bbox is not None) and file:
         raise ValueError('Either bbox or file must be provided')
 
     if bbox:
-        raise NotImplementedError(
-            "Haven't figured out how to fill cell intersections from bbox")
         # bbox = '-120.4906,37.9606,-119.6604,38.7561'
-        bbox = tuple(map(float, re.split(r'[, ]+', bbox)))
-        gdf = gpd.GeoDataFrame(geometry=[box(*bbox)], crs={'init': 'epsg:4326'})
+        bbox = tuple(map(float, re.split(r'[, ]+', bbox.strip())))
+        # Densify edges first, since straight lines in WGS84 are curved in the
+        # NDFD projection
+        geometry = shapely.segmentize(box(*bbox), 0.01)
+        gdf = gpd.GeoDataFrame(geometry=[geometry], crs='EPSG:4326')
         gdf = gdf.to_crs(crs=constants.crs)
-        int_gdf = intersect_with_grid(gdf.geometry[0].exterior.coords)
 
     if file:
-        gdfs = [gpd.read_file(f) for f in file]
-        gdf = gpd.GeoDataFrame(
-            pd.concat(gdfs, sort=False),
-            crs=gdfs[0].crs).to_crs(crs=constants.crs)
+        with metrics.timer('read_input'):
+            gdfs = [gpd.read_file(f) for f in file]
+            gdf = gpd.GeoDataFrame(
+                pd.concat(gdfs, sort=False),
+                crs=gdfs[0].crs).to_crs(crs=constants.crs)
 
-        # Get all coordinates
-        all_coords = []
-        for line in gdf.geometry:
-            msg = 'only LineString geometry currently supported'
-            assert line.type == 'LineString', msg
-            for coord in line.coords:
-                all_coords.append((coord[0], coord[1]))
+    metrics.count('geometries', len(gdf))
+    metrics.count(
+        'vertices', shapely.get_num_coordinates(gdf.geometry.values).sum())
+    with metrics.timer('intersect'):
+        cells = geometry_cells(
+            gdf.geometry.values, all_touched=all_touched,
+            supercover=supercover)
+        if buffer_cells:
+            cells = buffer_grid_cells(cells, buffer_cells)
 
-        int_gdf = intersect_with_grid(all_coords)
+        int_gdf = cells_to_gdf(cells[:, 0], cells[:, 1])
+    metrics.count('cells', len(int_gdf))
 
     # If requested, find elevation of each grid square centroid from NWS
-    # This requires two API calls: once for getting the forecast url, a second
-    # time for getting a forecast. The elevation value is only included in the
-    # forecast output.
     if elevations:
-        centroids = int_gdf.centroid
-        headers = {'accept': 'application/geo+json'}
-        elevations = []
-        for centroid in centroids:
-            lon, lat = centroid.coords[0]
-            url = f'https://api.weather.gov/points/{lat},{lon}'
-
-            sleep(0.1)
-            point_res = requests.get(url, headers=headers)
-            # Points in Mexico/Canada return 404
-            if point_res.status_code == 404:
-                elevations.append(np.nan)
-                continue
-            forecast_url = point_res.json()['properties']['forecast']
-
-            sleep(0.1)
-            forecast_res = requests.get(forecast_url, headers=headers)
-            if point_res.status_code == 404:
-                elevations.append(np.nan)
-                continue
-            ele = forecast_res.json()['properties']['elevation']
-
-            assert ele['unitCode'] == 'unit:m', 'Elevation not in meters'
-            value = ele['value']
-            elevations.append(value)
-
-        int_gdf['ele'] = elevations
-
-    print(int_gdf.to_json())
-
-
-def intersect_with_grid(int_coords, fill=False):
+        with metrics.timer('elevations'):
+            centroids = int_gdf.centroid
+            int_gdf['ele'] = elevation.get_elevations(
+                int_gdf['x'], int_gdf['y'], centroids.x, centroids.y,
+                api_url=api_url, rate=rate,
+                cache_path=elevation_cache or elevation.DEFAULT_CACHE_PATH)
+
+    with metrics.timer('write_output'):
+        print(int_gdf.to_json())
+
+    if metrics_json:
+        metrics.write_json(metrics_json)
+
+
+def geometry_cells(geometries, all_touched=False, supercover=False):
+    """Grid cells covered by projected geometries
+
+    LineStrings and MultiLineStrings cover the cells of their vertices, or
+    every cell they cross with `supercover`. Polygons and MultiPolygons cover
+    the cells whose center is inside them, or every cell they touch with
+    `all_touched`.
+
+    Args:
+        - geometries: array of shapely geometries in the NDFD projection
+        - all_touched: rule for polygons
+        - supercover: rule for lines
+
+    Returns:
+        array of shape (n, 2) of unique (x, y) grid indices
     """
+    geometries = np.asarray(geometries)
+    type_ids = shapely.get_type_id(geometries)
+    is_line = np.isin(type_ids, [1, 5])
+    is_polygon = np.isin(type_ids, [3, 6])
+    msg = 'only LineString and Polygon geometries are supported'
+    assert (is_line | is_polygon).all(), msg
+
+    if supercover:
+        cells = line_cells(geometries[is_line])
+        xs, ys = [cells[:, 0]], [cells[:, 1]]
+    else:
+        coords = shapely.get_coordinates(geometries[is_line])
+        x, y = grid_index(coords[:, 0], coords[:, 1])
+        xs, ys = [x], [y]
+
+    for polygon in geometries[is_polygon]:
+        cells = polygon_cells(polygon, all_touched=all_touched)
+        xs.append(cells[:, 0])
+        ys.append(cells[:, 1])
+
+    return unique_cells(np.concatenate(xs), np.concatenate(ys))
+
+
+def polygon_cells(polygon, all_touched=False):
+    """Grid cells covered by a projected Polygon or MultiPolygon
+
+    The polygon is rasterized over only the window of the grid that its bounds
+    cover, so the cost scales with the size of the polygon, not of the grid.
+    Holes are excluded.
+
     Args:
-        - int_coords: projected coordinates to be used for intersection
-        - fill: whether to include the interior of the intersected cells. I.e.
-          if the coords of a box are provided and intersect with 0,0 and 4,4,
-          this would include the entire 25-cell grid
+        - polygon: shapely Polygon or MultiPolygon in the NDFD projection
+        - all_touched: if True, include every cell the polygon touches.
+          Otherwise, include cells whose center is inside the polygon.
 
     Returns:
-        GeoDataFrame with three columns:
-        - x: x coordinate of NDFD grid. A higher x seems to move down, towards the south?
-        - y: y coordinate of NDFD grid. A higher y seems to move right, towards the east?
-        - geometry: geometry of grid cell (reprojected back into WGS84)
+        array of shape (n, 2) of (x, y) grid indices
     """
-    grid_path = create_grid()
-    with rasterio.Env(), rasterio.open(grid_path) as src:
-        intersected_cells = set()
-        for int_coord in int_coords:
-            intersected_cells.add(src.index(*int_coord))
+    minx, miny, maxx, maxy = polygon.bounds
+    (min_x, max_x), (min_y, max_y) = grid_index([minx, maxx], [maxy, miny])
+    row_off = max(min_x, 0)
+    col_off = max(min_y, 0)
+    height = min(max_x, constants.height - 1) - row_off + 1
+    width = min(max_y, constants.width - 1) - col_off + 1
+    if height <= 0 or width <= 0:
+        return np.empty((0, 2), dtype=np.int64)
 
-        if fill:
-            intersected_cells = fill_cells(intersected_cells)
+    window = rasterio.windows.Window(col_off, row_off, width, height)
+    mask = rasterio.features.rasterize(
+        [(polygon, 1)], out_shape=(height, width),
+        transform=rasterio.windows.transform(window, constants.aff),
+        all_touched=all_touched, dtype='uint8')
 
-        # For each of the cells, generate its box
-        cell_boxes = []
-        for x, y in list(intersected_cells):
-            cell_boxes.append([
-                x, y, box(*src.xy(x, y, 'll'), *src.xy(x, y, 'ur'))])
+    x, y = np.nonzero(mask)
+    return np.column_stack([x + row_off, y + col_off])
 
-    grid = gpd.GeoDataFrame(
-        cell_boxes, columns=['x', 'y', 'geometry'], crs=constants.crs)
-    return grid.to_crs(epsg=4326)
 
+def line_cells(lines):
+    """Every grid cell crossed by projected lines
+
+    For each segment, find the parameters t in [0, 1] at which it crosses a
+    grid row or column boundary, as in Amanatides & Woo's traversal. Between
+    two consecutive crossings the segment stays in one cell, which is the cell
+    of the midpoint. This is done for all segments at once with NumPy, instead
+    of stepping through cells one at a time.
 
-def fill_cells(cells):
-    """Fill interior of given cells so that there are no holes.
+    A segment passing exactly through a grid corner doesn't include the two
+    cells it only touches at that corner.
 
     Args:
-        - cells: tuples of (x, y) that represent existing cell intersections
+        - lines: array of shapely LineStrings or MultiLineStrings in the NDFD
+          projection
+
+    Returns:
+        array of shape (n, 2) of unique (x, y) grid indices
     """
-    # Generate cells covering all of min/max bounds, then intersect
-    # I do this with fstopo already
-    # The question is how to generate a polygon out of the current cells
-    pass
-
-
-def create_grid():
-    """Create raster file conforming to NDFD 2.5km CONUS grid
-
-    The easiest way to find the necessary constants is to find a
-    correctly-formatted GRIB file, and run:
-    ```
-    with rasterio.Env(), rasterio.open('YEUZ98_KWBN_201701010519') as r:
-        print(r.bounds)
-        print(r.transform)
-        print(r.crs)
-    ```
+    # Parts of MultiLineStrings must not be joined, so split on part too
+    parts = shapely.get_parts(lines)
+    coords, part_idx = shapely.get_coordinates(parts, return_index=True)
+    row, col = grid_coords(coords[:, 0], coords[:, 1])
+
+    # Segments are pairs of consecutive vertices of the same part
+    same = part_idx[:-1] == part_idx[1:]
+    r0, c0 = row[:-1][same], col[:-1][same]
+    r1, c1 = row[1:][same], col[1:][same]
+    n_segments = len(r0)
+
+    seg, t = [np.arange(n_segments), np.arange(n_segments)], [
+        np.zeros(n_segments), np.ones(n_segments)]
+    for a0, a1 in ((r0, r1), (c0, c1)):
+        # Grid lines k crossed, from floor(min) + 1 to floor(max)
+        lo = np.floor(np.minimum(a0, a1))
+        n = (np.floor(np.maximum(a0, a1)) - lo).astype(np.int64)
+        crossing_seg = np.repeat(np.arange(n_segments), n)
+        offset = np.arange(n.sum()) - np.repeat(np.cumsum(n) - n, n)
+        k = lo[crossing_seg] + 1 + offset
+        seg.append(crossing_seg)
+        t.append((k - a0[crossing_seg]) / (a1 - a0)[crossing_seg])
+
+    seg = np.concatenate(seg)
+    t = np.concatenate(t)
+    order = np.lexsort((t, seg))
+    seg, t = seg[order], t[order]
+
+    # Cell of midpoint between consecutive crossings of the same segment
+    keep = (seg[:-1] == seg[1:]) & (t[1:] - t[:-1] > 1e-12)
+    s = seg[:-1][keep]
+    t_mid = (t[:-1][keep] + t[1:][keep]) / 2
+    x = np.floor(r0[s] + t_mid * (r1 - r0)[s]).astype(np.int64)
+    y = np.floor(c0[s] + t_mid * (c1 - c0)[s]).astype(np.int64)
+
+    # Always include cells of vertices, as without supercover
+    vx, vy = grid_index(coords[:, 0], coords[:, 1])
+    return unique_cells(np.concatenate([x, vx]), np.concatenate([y, vy]))
+
+
+def buffer_grid_cells(cells, n):
+    """Add every cell within n cells of given cells, i.e. dilate by a disk
+
+    Args:
+        - cells: array of shape (m, 2) of (x, y) grid indices
+        - n: radius in cells
+
+    Returns:
+        array of shape (k, 2) of unique (x, y) grid indices within the grid
+    """
+    dx, dy = np.mgrid[-n:n + 1, -n:n + 1]
+    disk = dx ** 2 + dy ** 2 <= n ** 2
+    offsets = np.column_stack([dx[disk], dy[disk]])
+
+    buffered = (cells[:, None, :] + offsets[None, :, :]).reshape(-1, 2)
+    inside = (
+        (buffered[:, 0] >= 0) & (buffered[:, 0] < constants.height) &
+        (buffered[:, 1] >= 0) & (buffered[:, 1] < constants.width))
+    buffered = buffered[inside]
+    return unique_cells(buffered[:, 0], buffered[:, 1])
+
+
+def grid_coords(xs, ys):
+    """Fractional NDFD grid row and column of projected coordinates
+
+    The integer part is the cell index, as from `grid_index`.
+    """
+    col, row = ~constants.aff * (np.asarray(xs), np.asarray(ys))
+    return row, col
+
+
+def grid_index(xs, ys, aff=constants.aff):
+    """NDFD grid indices of the cells containing projected coordinates
+
+    This uses the inverse of the grid's affine transform on whole arrays at
+    once, so it's the same as calling `src.index` on a raster of the grid for
+    each coordinate, without needing such a raster.
+
+    Args:
+        - xs, ys: arrays of coordinates in the NDFD projection
+        - aff: affine transform of the grid, by default the 2.5km grid
+
+    Returns:
+        (x, y) arrays of grid row and column indices. Coordinates outside of
+        the grid get indices outside of it too.
     """
-    # In NDFD coordinates, it spans from the minx to maxx with 2145 horizontal
-    # cells
-    # If spans from miny to maxy in 1377 vertical cells.
-    # This makes each side of each cell 2,539.7 meters
-    x = np.linspace(-2764474.35, 2683182.15, 2145)
-    y = np.linspace(-265055.18999999994, 3232111.71, 1377)
-    # Make 2D arrays for x and y
-    X, Y = np.meshgrid(x, y)
-    # set third dimension to 0 for this example, with same dimensions as X and Y
-    Z = X * 0
-
-    path = os.path.join(tempfile.mkdtemp(), 'grid.tif')
-    with rasterio.open(path, 'w', driver='GTiff', height=Z.shape[0],
-                       width=Z.shape[1], count=1, dtype=Z.dtype,
-                       crs=constants.crs,
-                       transform=constants.aff) as new_dataset:
-        new_dataset.write(Z, 1)
-    return path
+    x, y = rasterio.transform.rowcol(aff, xs, ys)
+    return np.asarray(x), np.asarray(y)
+
+
+def cell_centers(x, y, aff=constants.aff):
+    """Projected coordinates of the centers of grid cells
+
+    Args:
+        - x, y: arrays of grid row and column indices
+        - aff: affine transform of the grid, by default the 2.5km grid
+
+    Returns:
+        (xs, ys) arrays of coordinates in the NDFD projection
+    """
+    xs, ys = rasterio.transform.xy(aff, np.asarray(x), np.asarray(y))
+    return np.asarray(xs), np.asarray(ys)
+
+
+def unique_cells(x, y):
+    """Unique (x, y) pairs of grid indices
+
+    Indices are packed into one int64 per cell, which is much faster to sort
+    than rows of a 2D array. Indices outside of the grid, including negative
+    ones, are kept.
+
+    Returns:
+        array of shape (n, 2) of (x, y), sorted by x then y
+    """
+    key = (np.asarray(x, dtype=np.int64) << 32) | (
+        np.asarray(y, dtype=np.int64) & 0xFFFFFFFF)
+    key = np.unique(key)
+    x = key >> 32
+    y = (key & 0xFFFFFFFF).astype(np.uint32).astype(np.int32)
+    return np.column_stack([x, y])
+
+
+def cells_to_gdf(x, y):
+    """GeoDataFrame of grid cells, with the geometry of each cell in WGS84
+
+    Args:
+        - x, y: arrays of grid row and column indices
+    """
+    x = np.asarray(x)
+    y = np.asarray(y)
+    minx, miny = rasterio.transform.xy(constants.aff, x, y, offset='ll')
+    maxx, maxy = rasterio.transform.xy(constants.aff, x, y, offset='ur')
+    geometry = shapely.box(minx, miny, maxx, maxy)
+
+    grid = gpd.GeoDataFrame(
+        {'x': x, 'y': y}, geometry=geometry, crs=constants.crs)
+    return grid.to_crs(epsg=4326)
 
 
 if __name__ == '__main__':
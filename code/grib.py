@@ -0,0 +1,118 @@
+"""
+grib.py: Decode single NDFD GRIB messages
+
+Functions here are kept free of tarfile handles and other unpicklable state so
+that they can be run inside worker processes by `import.py`.
+
+A member is passed either as the bytes of the GRIB file, or as a GDAL path that
+GDAL can read in place, e.g. `/vsitar//data/YEUZ98.tar/YEUZ98_KWBN_2017...`.
+"""
+import re
+from contextlib import contextmanager
+from datetime import datetime
+
+import numpy as np
+import rasterio
+from rasterio.io import MemoryFile
+
+
+def parse_grib_time(time_str):
+    """Parse GDAL GRIB time tag, e.g. '  1483246800 sec UTC', into datetime
+
+    Newer versions of GDAL omit the ' sec UTC' suffix.
+    """
+    time_regex = r'^\s*(\d+)(\s*sec\s*UTC)?\s*$'
+    time_int = int(re.match(time_regex, time_str).group(1))
+    return datetime.utcfromtimestamp(time_int)
+
+
+def vsi_member_path(tar_path, name):
+    """GDAL virtual filesystem path of member inside tarball on disk
+
+    /vsitar/ handles gzipped tarballs transparently. Members that are
+    themselves gzipped are additionally opened through /vsigzip/.
+    """
+    path = f'/vsitar/{tar_path}/{name}'
+    if name.endswith('.gz'):
+        path = f'/vsigzip/{path}'
+    return path
+
+
+@contextmanager
+def open_member(src):
+    """Open GRIB member from bytes or from a GDAL path
+    """
+    with rasterio.Env():
+        if isinstance(src, str):
+            with rasterio.open(src) as dataset:
+                yield dataset
+        else:
+            with MemoryFile(src) as memfile, memfile.open() as dataset:
+                yield dataset
+
+
+def read_times(name, src):
+    """Read forecast and valid time of a GRIB member without decoding its data
+
+    GDAL only parses the GRIB headers when opening the dataset; raster data
+    isn't decoded until it's read.
+
+    Returns:
+        tuple of (fcst_time, valid_time), or None if the member could not be
+        opened
+    """
+    try:
+        with open_member(src) as dataset:
+            tags = dataset.tags(1)
+    except rasterio.errors.RasterioIOError as e:
+        print(f'Unable to open {name} out of tarball')
+        print(e)
+        return None
+
+    fcst_time = parse_grib_time(tags['GRIB_REF_TIME'])
+    valid_time = parse_grib_time(tags['GRIB_VALID_TIME'])
+    return fcst_time, valid_time
+
+
+def decode_member(name, src, plans):
+    """Decode a single GRIB member and select grid cells
+
+    Args:
+        - name: name of member within tarball; only used for logging
+        - src: bytes of GRIB file, or GDAL path to it
+        - plans: dict of {(height, width): list of WindowRead} from
+          `grids.plan_grids`, giving for each known grid the windows to read
+          from the first band and cells to take from each
+
+    Returns:
+        tuple of (fcst_time, valid_time, values), or None if the member could
+        not be opened or isn't on a known grid
+    """
+    try:
+        with open_member(src) as dataset:
+            plan = plans.get(dataset.shape)
+            if plan is None:
+                print(f'Unknown grid of shape {dataset.shape} in {name}')
+                return None
+
+            # Read data of predefined windows into arrays. Using windows
+            # means least reading necessary compared to reading for
+            # entire CONUS
+            arrs = [dataset.read(1, window=w.window) for w in plan]
+            fcst_time_str = dataset.tags(1)['GRIB_REF_TIME']
+            valid_time_str = dataset.tags(1)['GRIB_VALID_TIME']
+    except rasterio.errors.RasterioIOError as e:
+        print(f'Unable to open {name} out of tarball')
+        print(e)
+        return None
+
+    # Select cell values according to indices adjusted for window extent
+    # This syntax is basically equivalent to zip() over the x/y cols
+    n_cells = sum(len(w.index) for w in plan)
+    values = np.empty(n_cells, dtype=arrs[0].dtype)
+    for w, arr in zip(plan, arrs):
+        values[w.index] = arr[w.rows, w.cols]
+
+    fcst_time = parse_grib_time(fcst_time_str)
+    valid_time = parse_grib_time(valid_time_str)
+    return fcst_time, valid_time, values
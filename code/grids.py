@@ -0,0 +1,81 @@
+"""
+grids.py: Registry of NDFD CONUS grids, and lookup of grid cells across them
+
+Since 2005 CONUS data have used two grids: a 5km grid through August 2014, and
+the 2.5km grid since October 2014 (see README). Grid cells are always given in
+2.5km grid indices, i.e. `x` and `y` of `get_grid.py`. A GRIB member's grid is
+detected from its shape, and values are taken from the cell of that grid that
+contains the center of each 2.5km cell. On the 5km grid, four 2.5km cells
+share each 5km cell.
+
+Lookup tables from 2.5km cells to each grid's cells, and the windows to read
+from each grid, are computed once per set of grid cells and cached.
+"""
+from collections import namedtuple
+from functools import lru_cache
+
+import numpy as np
+
+import constants
+from get_grid import cell_centers, grid_index
+from windows import plan_windows
+
+Grid = namedtuple('Grid', ['name', 'height', 'width', 'aff'])
+
+GRIDS = [
+    Grid('2.5km', constants.height, constants.width, constants.aff),
+    Grid('5km', constants.height_5km, constants.width_5km, constants.aff_5km),
+]
+# Grids by (height, width), i.e. rasterio dataset shape
+GRIDS_BY_SHAPE = {(g.height, g.width): g for g in GRIDS}
+
+
+def cell_lookup(grid, x, y):
+    """Row and column of cells of `grid` containing centers of 2.5km cells
+
+    Args:
+        - grid: Grid to look up cells in
+        - x, y: 2.5km grid row and column indices
+
+    Returns:
+        (rows, cols) arrays of indices in `grid`
+    """
+    x = np.asarray(x)
+    y = np.asarray(y)
+    if grid.aff == constants.aff:
+        return x, y
+
+    px, py = cell_centers(x, y)
+    rows, cols = grid_index(px, py, aff=grid.aff)
+
+    msg = f'Grid cells outside of the {grid.name} grid'
+    assert ((rows >= 0) & (rows < grid.height)).all(), msg
+    assert ((cols >= 0) & (cols < grid.width)).all(), msg
+    return rows, cols
+
+
+def plan_grids(x, y):
+    """Window plans for reading 2.5km cells from a member of any known grid
+
+    Args:
+        - x, y: 2.5km grid row and column indices of cells to select
+
+    Returns:
+        dict of {(height, width): list of WindowRead}
+    """
+    x = np.ascontiguousarray(x, dtype=np.int64)
+    y = np.ascontiguousarray(y, dtype=np.int64)
+    return _plan_grids(x.tobytes(), y.tobytes())
+
+
+@lru_cache(maxsize=8)
+def _plan_grids(x_bytes, y_bytes):
+    x = np.frombuffer(x_bytes, dtype=np.int64)
+    y = np.frombuffer(y_bytes, dtype=np.int64)
+
+    plans = {}
+    for grid in GRIDS:
+        rows, cols = cell_lookup(grid, x, y)
+        plans[(grid.height, grid.width)] = plan_windows(rows, cols)
+
+    return plans
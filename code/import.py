@@ -1,18 +1,32 @@
-import re
 import tarfile
-from datetime import datetime
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 from tempfile import TemporaryDirectory
-from urllib.request import urlretrieve
 
 import click
 import geopandas as gpd
 import pandas as pd
-import rasterio
 from dateutil.parser import parse
-from rasterio.io import MemoryFile
-from rasterio.windows import Window
-from tqdm import tqdm
+
+import jobs
+import metrics
+from download import Prefetcher, open_url_stream
+from grib import decode_member, read_times, vsi_member_path
+from grids import plan_grids
+from writer import PartitionedWriter
+
+
+def _parse_shard(ctx, param, value):
+    """Click callback parsing --shard i/n into (i, n)
+    """
+    if value is None:
+        return None
+
+    try:
+        return jobs.parse_shard(value)
+    except ValueError as e:
+        raise click.BadParameter(str(e))
 
 
 # url = 'HAS011421999'
@@ -47,38 +61,215 @@ from tqdm import tqdm
     default=None,
     type=str,
     help='Last date of tarball to download')
+@click.option(
+    '-w',
+    '--workers',
+    required=False,
+    default=1,
+    show_default=True,
+    type=click.IntRange(min=1),
+    help='Number of processes to use for decoding GRIB files')
+@click.option(
+    '--stream',
+    is_flag=True,
+    default=False,
+    help='Decode tarballs as they download, without saving them to disk')
+@click.option(
+    '--prefetch',
+    required=False,
+    default=0,
+    show_default=True,
+    type=click.IntRange(min=0),
+    help='Number of tarballs to download ahead of the one being imported')
+@click.option(
+    '--disk-budget',
+    required=False,
+    default=None,
+    type=click.FloatRange(min=0),
+    help='Maximum GB of downloaded tarballs to keep on disk at once')
+@click.option(
+    '--download-dir',
+    required=False,
+    default=None,
+    type=click.Path(file_okay=False, dir_okay=True, resolve_path=True),
+    help='Directory for downloaded tarballs. Partial downloads are resumed.')
+@click.option(
+    '--raw',
+    is_flag=True,
+    default=False,
+    help=(
+        'Import every forecast, instead of only the newest forecast for each '
+        'valid time in a tarball. Always on with --stream.'))
+@click.option(
+    '--vsitar',
+    is_flag=True,
+    default=False,
+    help=(
+        'Read GRIB files in place from downloaded tarballs with GDAL, instead '
+        'of copying them into memory. Ignored with --stream.'))
+@click.option(
+    '--metrics-json',
+    required=False,
+    default=None,
+    type=click.Path(file_okay=True, dir_okay=False, resolve_path=True),
+    help='Write time spent in each stage and counts of bytes, members, '
+    'decode failures and rows to this JSON file')
+@click.option(
+    '--profile',
+    required=False,
+    default=None,
+    type=click.Path(file_okay=True, dir_okay=False, resolve_path=True),
+    help='Write cProfile stats of the member loop of each tarball to this '
+    'file. Decoding in worker processes isn\'t profiled, so use with -w 1.')
+@click.option(
+    '--jobs-db',
+    required=False,
+    default=None,
+    type=click.Path(file_okay=True, dir_okay=False, resolve_path=True),
+    help='SQLite file recording progress, so that a rerun skips tarballs and '
+    'members already imported. Default: _jobs.sqlite in data directory')
+@click.option(
+    '--shard',
+    required=False,
+    default=None,
+    type=str,
+    callback=_parse_shard,
+    help='Only import tarballs of shard i of n, e.g. 0/4, to split an import '
+    'across machines')
 @click.argument('urls', required=True, nargs=-1, type=str)
-def main(grid_path, data_dir, start_date, end_date, urls):
-    """Download and import NDFD GRIB files"""
+def main(
+        grid_path, data_dir, start_date, end_date, workers, stream, prefetch,
+        disk_budget, download_dir, raw, vsitar, metrics_json, profile, jobs_db,
+        shard, urls):
+    """Download and import NDFD GRIB files
+
+    URLS are HAS extract ids, e.g. HAS011421999, or paths to tarballs already
+    on disk.
+    """
+    # Create data_dir if it doesn't yet exist
+    data_dir = Path(data_dir)
+    data_dir.mkdir(exist_ok=True, parents=True)
+    job_catalog = jobs.JobCatalog(jobs_db or data_dir / jobs.DEFAULT_NAME)
+
     all_tar_urls = []
+    tar_paths = []
     for url in urls:
+        # Local tarballs are imported in place, and never deleted
+        if Path(url).is_file():
+            tar_paths.append(Path(url).resolve())
+            continue
+
         if not url.startswith('HAS'):
-            raise ValueError('url should start with HAS, e.g. HAS011421999')
+            raise ValueError(
+                'url should start with HAS, e.g. HAS011421999, or be a path '
+                'to a tarball')
 
         # Query webpage to find individual tarball URLs in extract
-        url = 'https://www1.ncdc.noaa.gov/pub/has/' + url
-        tar_urls = get_extract_urls(url, start_date, end_date)
+        tar_urls = get_extract_urls(
+            'https://www1.ncdc.noaa.gov/pub/has/' + url, start_date, end_date)
+        job_catalog.add_extract(url, tar_urls)
         all_tar_urls.extend(tar_urls)
+    job_catalog.add_tarballs(tar_paths)
+
+    # Keep this machine's share of tarballs, and skip those already imported
+    all_tar_urls = job_catalog.pending(
+        [u for u in all_tar_urls if jobs.in_shard(Path(u).name, shard)])
+    tar_paths = job_catalog.pending(
+        [p for p in tar_paths if jobs.in_shard(p.name, shard)])
+    print(f'Importing {len(all_tar_urls) + len(tar_paths)} tarballs')
 
     # Load grid
     grid = gpd.read_file(grid_path)
 
-    # Create data_dir if it doesn't yet exist
-    data_dir = Path(data_dir)
-    data_dir.mkdir(exist_ok=True, parents=True)
-
-    # For each tarball url, download and import it
-    for tar_url in all_tar_urls:
-        with TemporaryDirectory() as dirpath:
-            # Download tar_url to that directory
-            local_path = Path(dirpath) / Path(tar_url).name
-            download_url(tar_url, local_path)
-
-            with tarfile.open(local_path) as tf:
-                import_tarfile(tf=tf, grid=grid, data_dir=data_dir)
-
-
-def import_tarfile(tf, grid, data_dir):
+    if profile:
+        metrics.enable_profiling()
+
+    # One pool decodes the members of every tarball
+    executor = decode_pool(grid, workers)
+
+    # Buffered rows are flushed when leaving this block, including when the
+    # import is interrupted. Metrics are written then too, so that a long
+    # import that fails still shows where its time went.
+    try:
+        with PartitionedWriter(
+                data_dir, on_flush=job_catalog.flushed) as writer:
+            for tar_path in tar_paths:
+                metrics.count('tarballs')
+                with job_catalog.importing(tar_path) as job, \
+                        tarfile.open(tar_path) as tf:
+                    import_tarfile(
+                        tf=tf, grid=grid, writer=writer, workers=workers,
+                        latest_only=not raw,
+                        tar_path=str(tar_path) if vsitar else None, job=job,
+                        executor=executor)
+
+            import_tar_urls(
+                all_tar_urls, grid=grid, writer=writer, workers=workers,
+                stream=stream, prefetch=prefetch, disk_budget=disk_budget,
+                download_dir=download_dir, latest_only=not raw, vsitar=vsitar,
+                job_catalog=job_catalog, executor=executor)
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+        job_catalog.close()
+        if metrics_json:
+            metrics.write_json(metrics_json)
+        if profile:
+            metrics.write_profile(profile)
+
+
+def import_tar_urls(
+        tar_urls, grid, writer, workers, stream, prefetch, disk_budget,
+        download_dir, latest_only, vsitar, job_catalog, executor=None):
+    """Download and import each tarball url
+
+    Progress of each tarball is recorded in `job_catalog`, a JobCatalog.
+    Members are decoded in `executor`, from `decode_pool`, if provided.
+    """
+    # Streamed tarballs can't be read twice, so skipping superseded forecasts
+    # isn't possible
+    if stream:
+        for tar_url in tar_urls:
+            metrics.count('tarballs')
+            with job_catalog.importing(tar_url) as job, \
+                    open_url_stream(tar_url) as res, \
+                    tarfile.open(fileobj=res, mode='r|*') as tf:
+                import_tarfile(
+                    tf=tf, grid=grid, writer=writer, workers=workers, job=job,
+                    executor=executor)
+        return
+
+    max_bytes = disk_budget * 1e9 if disk_budget is not None else None
+    with TemporaryDirectory() as tempdir:
+        dirpath = tempdir
+        if download_dir is not None:
+            dirpath = Path(download_dir)
+            dirpath.mkdir(exist_ok=True, parents=True)
+
+        # Download the next tarballs in the background while importing the
+        # current one. Only time spent waiting on a download counts towards
+        # the download stage; prefetched downloads overlap with importing.
+        # A tarball that fails to download is marked failed, to be retried by
+        # a rerun, and the import goes on with the next one
+        prefetcher = Prefetcher(
+            tar_urls, dirpath, prefetch=prefetch, max_bytes=max_bytes,
+            on_error=job_catalog.tarball_failed)
+        for tar_url, local_path in metrics.timed_iter('download', prefetcher):
+            metrics.count('tarballs')
+            metrics.count('download_bytes', Path(local_path).stat().st_size)
+            job_catalog.set_tarball_state(tar_url, 'downloaded')
+            with job_catalog.importing(tar_url) as job, \
+                    tarfile.open(local_path) as tf:
+                import_tarfile(
+                    tf=tf, grid=grid, writer=writer, workers=workers,
+                    latest_only=latest_only,
+                    tar_path=local_path if vsitar else None, job=job,
+                    executor=executor)
+
+
+def import_tarfile(
+        tf, grid, writer, workers=1, latest_only=False, tar_path=None,
+        job=None, executor=None):
     """Import tarball of GRIB files and save to data directory
 
     - iterate over each member in the tarfile, extracting it into memory
@@ -98,74 +289,243 @@ def import_tarfile(tf, grid, data_dir):
         - fcst_time: timestamp in UTC of when forecast was made
         Other metadata? Unit of measurement?
 
-    Figure out which file format is best for these incremental appends
+    Rows are handed to `writer`, which batches them into large parquet files
+    partitioned by element/year/month.
+
+    Decoding is CPU-bound, so when `workers` is greater than 1, members are
+    read out of the tarball in this process and decoded in a process pool.
+    Results are still written in tarball order.
+
+    Members are visited in a single forward pass, so `tf` may also be a tarfile
+    opened in streaming mode, e.g. `tarfile.open(fileobj=response, mode='r|*')`.
+
+    When `latest_only` is set, GRIB headers of every member are scanned first,
+    and only the member with the newest forecast for each valid time is
+    decoded. This needs a second pass over the tarball, so it can't be used in
+    streaming mode. Note that `coalesce.py` falls back to an older forecast for
+    cells where the newest one is missing; that isn't possible for forecasts
+    skipped here.
+
+    Time spent in each stage is recorded in `metrics`: `scan_headers`,
+    `tar_read` for reading members out of the tarball, `decode` for opening
+    each member and reading its windows (GDAL decodes the message on the first
+    read, so these can't be told apart), and the writer's `write_buffer` and
+    `parquet_write`. With profiling enabled, the member loop is profiled.
 
     Args:
         - tf: opened tarfile
         - grid: DataFrame with `x` and `y` columns defining grid cells to select
-        - data_dir: Where to save data
+        - writer: PartitionedWriter for data directory
+        - workers: number of processes to use for decoding GRIB members
+        - latest_only: only decode newest forecast for each valid time
+        - tar_path: optional path of `tf` on disk. If provided, members are
+          opened in place by GDAL through /vsitar/, instead of being copied
+          into memory. Workers then receive only the path of each member.
+        - job: optional jobs.TarballJob. Members it has as written are
+          skipped, and the others are recorded in it as decoded or failed.
+        - executor: optional pool from `decode_pool(grid, workers)`, to share
+          between tarballs. Without it, a pool is started for this tarball
+          when `workers` is greater than 1.
+    """
+    # Counters that a clean import never increments are still reported, as 0
+    for name in ('members', 'decode_failures', 'rows'):
+        metrics.count(name, 0)
+
+    own_executor = executor is None
+    if own_executor:
+        executor = decode_pool(grid, workers)
+    # Keep a few members per worker in flight so that workers don't starve
+    # while this process reads the next members out of the tarball
+    max_pending = workers * 4
+
+    try:
+        keep = None
+        skip = job.written if job is not None else set()
+        if latest_only:
+            with metrics.timer('scan_headers'):
+                keep = find_latest_members(tf, executor, max_pending, tar_path)
+            keep -= skip
+            if job is not None:
+                job.listed(keep)
+
+        with metrics.profiled():
+            _import_members(
+                tf, grid, writer, executor, keep, skip, tar_path, max_pending,
+                job)
+    finally:
+        if own_executor and executor is not None:
+            executor.shutdown(cancel_futures=True)
+
+
+def decode_pool(grid, workers):
+    """Process pool for decoding members onto grid, or None for 1 worker
+
+    Window plans of the grid are sent to each worker once, when it starts, so
+    that tasks only carry the bytes or /vsitar/ path of a member. Plans are
+    set in this process too, for decoding without a pool.
+    """
+    # Windows to read from each GRIB file, for each grid that the file could
+    # be on. For a compact grid this is just its bounding box; for a long,
+    # thin grid it's a few tighter strips.
+    plans = plan_grids(grid['x'].values, grid['y'].values)
+    _set_plans(plans)
+    if workers == 1:
+        return None
+
+    return ProcessPoolExecutor(
+        max_workers=workers, initializer=_set_plans, initargs=(plans,))
+
+
+# Window plans of the grid being imported, in each process
+_plans = None
+
+
+def _set_plans(plans):
+    global _plans
+    _plans = plans
+
+
+def _import_members(
+        tf, grid, writer, executor, keep, skip, tar_path, max_pending, job):
+    """Decode members of tarball and hand their rows to writer
+    """
+    members = metrics.timed_iter(
+        'tar_read', _read_members(tf, keep, skip, tar_path))
+    results = _map_ordered(
+        executor, _decode_member_args, members, max_pending=max_pending)
+
+    for name, decoded, seconds in results:
+        metrics.add_time('decode', seconds)
+        metrics.count('members')
+        # Members that failed to open have already been logged
+        if decoded is None:
+            metrics.count('decode_failures')
+            if job is not None:
+                job.failed(name, 'could not be decoded')
+            continue
+
+        fcst_timestamp, valid_timestamp, values = decoded
+
+        # Create new dataframe with just desired cells and their values
+        new_data = grid[['x', 'y']].copy()
+        new_data['vals'] = values
+        new_data['fcst_time'] = fcst_timestamp
+        new_data['valid_time'] = valid_timestamp
+
+        metrics.count('rows', len(new_data))
+        # Record the member before writing, since the write may flush the
+        # buffer, and the member must be marked written by that flush
+        if job is not None:
+            job.decoded(name)
+        writer.write(name, new_data)
+
+
+def find_latest_members(tf, executor=None, max_pending=1, tar_path=None):
+    """Find names of members holding the newest forecast for each valid time
+
+    Only GRIB headers are parsed; no raster data is decoded. `coalesce.py` only
+    keeps the latest forecast for each valid time, so older forecasts in the
+    same tarball don't need to be decoded at all.
+
+    Args:
+        - tf: opened tarfile. Must be seekable, since it will be read again
+          afterwards.
+        - executor: optional process pool to parse headers in
+        - max_pending: maximum number of members in flight in executor
+        - tar_path: optional path of `tf` on disk, to read members in place
+
+    Returns:
+        set of member names
+    """
+    # (element, valid_time) -> (fcst_time, name)
+    latest = {}
+    results = _map_ordered(
+        executor, _read_times_args, _read_members(tf, tar_path=tar_path),
+        max_pending=max_pending)
+    for name, times in results:
+        if times is None:
+            continue
+
+        fcst_time, valid_time = times
+        key = (name[:3], valid_time)
+        if key not in latest or fcst_time >= latest[key][0]:
+            latest[key] = (fcst_time, name)
+
+    return {name for _, name in latest.values()}
+
+
+def _read_members(tf, keep=None, skip=(), tar_path=None):
+    """Yield (name, src) for GRIB members of interest in tarball
+
+    `src` is the bytes of the member or, if `tar_path` is provided, its GDAL
+    /vsitar/ path.
+
+    Args:
+        - tf: opened tarfile
+        - keep: optional set of member names to restrict to
+        - skip: member names to leave out
+        - tar_path: optional path of `tf` on disk
     """
     # Find members of interest:
     # Keep only files that are Z98
     # Z97 corresponds to 4-7 day forecasts
     # Z98 corresponds to 1-3 day forecasts
-    names = [x for x in tf.getnames() if x[3:6] == 'Z98']
-
-    minx, miny, maxx, maxy = (
-        grid['x'].min(), grid['y'].min(), grid['x'].max(), grid['y'].max())
-    window = Window.from_slices((minx, maxx + 1), (miny, maxy + 1))
-
-    # Since you're only reading a part of the dataset, you need to adjust the
-    # x/y grid values to be relative from the minx/miny
-    grid['adj_x'] = grid['x'] - minx
-    grid['adj_y'] = grid['y'] - miny
-
-    for name in names:
-        with rasterio.Env(), tf.extractfile(name) as f, MemoryFile(
-                f.read()) as memfile:
-
-            try:
-                with memfile.open() as dataset:
-                    # Read data of predefined window into array Using window
-                    # means least reading necessary compared to reading for
-                    # entire CONUS
-                    #
-                    # Theoretically since the grid cells I'm interested in
-                    # aren't an even box, you could read less data by iterating
-                    # over each cell as its own window, but that might have
-                    # higher overhead, and this is simpler
-                    arr = dataset.read(1, window=window)
-                    fcst_time_str = dataset.tags(1)['GRIB_REF_TIME']
-                    valid_time_str = dataset.tags(1)['GRIB_VALID_TIME']
-            except rasterio.errors.RasterioIOError as e:
-                print(f'Unable to open {name} out of tarball')
-                print(e)
-                continue
-
-            # Select cell values according to indices adjusted for window extent
-            # This syntax is basically equivalent to zip() over the x/y cols
-            values = arr[grid['adj_x'].values, grid['adj_y'].values]
-            msg = 'values should have same length as provided indices'
-            assert len(values) == len(grid), msg
-
-            # Create new dataframe with just desired cells and their values
-            new_data = grid[['x', 'y']].copy()
-            new_data['vals'] = values
-
-            # Timestamp of when forecast was made
-            time_regex = r'^(\d+)\s*sec\s*UTC$'
-            fcst_time_int = int(re.match(time_regex, fcst_time_str).group(1))
-            fcst_timestamp = datetime.utcfromtimestamp(fcst_time_int)
-
-            # Timestamp of when forecast was valid for
-            valid_time_int = int(re.match(time_regex, valid_time_str).group(1))
-            valid_timestamp = datetime.utcfromtimestamp(valid_time_int)
-
-            new_data['fcst_time'] = fcst_timestamp
-            new_data['valid_time'] = valid_timestamp
-
-            out_path = data_dir / f'{name}.parquet'
-            new_data.to_parquet(out_path, index=False)
+    #
+    # Each member has to be read before advancing to the next, since in
+    # streaming mode earlier members can't be revisited
+    for member in tf:
+        if not member.isfile() or member.name[3:6] != 'Z98':
+            continue
+
+        if keep is not None and member.name not in keep:
+            continue
+
+        if member.name in skip:
+            continue
+
+        # Includes members read when scanning headers with latest_only
+        metrics.count('member_bytes', member.size)
+        if tar_path is not None:
+            yield member.name, vsi_member_path(tar_path, member.name)
+            continue
+
+        with tf.extractfile(member) as f:
+            yield member.name, f.read()
+
+
+def _decode_member_args(args):
+    name, src = args
+    decoded, seconds = metrics.timed_call(decode_member, name, src, _plans)
+    return name, decoded, seconds
+
+
+def _read_times_args(args):
+    return args[0], read_times(*args)
+
+
+def _map_ordered(executor, fn, iterable, max_pending):
+    """Map fn over iterable, in executor if provided, preserving order
+    """
+    if executor is None:
+        return map(fn, iterable)
+
+    return _imap_ordered(executor, fn, iterable, max_pending)
+
+
+def _imap_ordered(executor, fn, iterable, max_pending):
+    """Like executor.map, but with a bound on the number of pending futures
+
+    executor.map submits the entire iterable up front, which would read every
+    member of the tarball into memory at once.
+    """
+    pending = deque()
+    for item in iterable:
+        pending.append(executor.submit(fn, item))
+        if len(pending) >= max_pending:
+            yield pending.popleft().result()
+
+    while pending:
+        yield pending.popleft().result()
 
 
 def get_extract_urls(url, start_date, end_date):
@@ -192,18 +552,5 @@ def get_extract_urls(url, start_date, end_date):
     return (url.rstrip('/') + '/' + df['Name']).values
 
 
-class DownloadProgressBar(tqdm):
-    def update_to(self, b=1, bsize=1, tsize=None):
-        if tsize is not None:
-            self.total = tsize
-        self.update(b * bsize - self.n)
-
-
-def download_url(url, output_path):
-    with DownloadProgressBar(unit='B', unit_scale=True, miniters=1,
-                             desc=url.split('/')[-1]) as t:
-        urlretrieve(url, filename=output_path, reporthook=t.update_to)
-
-
 if __name__ == '__main__':
     main()
@@ -0,0 +1,312 @@
+"""
+jobs.py: Catalog of import jobs, for resuming interrupted imports
+
+An import of a few HAS extracts runs for many hours, and used to restart from
+the first tarball when interrupted. `import.py` now records the state of each
+extract, tarball and GRIB member in a SQLite file, by default
+`data_dir/_jobs.sqlite`, so a rerun with the same arguments skips completed
+work and retries only what failed or never finished.
+
+States are, in order:
+
+- listed: tarball urls of an extract were found, or a member was selected for
+  decoding
+- downloaded: tarball is on disk
+- decoded: all members of a tarball were decoded, or a member was decoded, but
+  rows may still be buffered in the writer
+- written: rows are in parquet files on disk. The writer's buffer is flushed
+  across tarballs, so members and tarballs only move to this state when it is
+  flushed.
+- failed: member couldn't be decoded, or importing the tarball raised. A
+  tarball with failed members ends up failed too.
+
+A rerun imports every tarball that isn't written, and skips its members that
+are. An extract is written once all of its tarballs are.
+
+With `--shard i/n`, a tarball is only imported by shard `crc32(name) % n`, so
+`n` machines can each import their share of the same extracts without any
+coordination, each into its own data directory.
+
+To see progress of an import:
+```
+python code/jobs.py data/raw/_jobs.sqlite
+```
+"""
+import sqlite3
+import zlib
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from pathlib import Path
+
+import click
+import pandas as pd
+
+DEFAULT_NAME = '_jobs.sqlite'
+STATES = ['listed', 'downloaded', 'decoded', 'written', 'failed']
+
+
+@click.command()
+@click.argument(
+    'path',
+    required=True,
+    type=click.Path(
+        exists=True, file_okay=True, dir_okay=False, resolve_path=True))
+def main(path):
+    """Print import progress of each extract in job catalog at PATH
+    """
+    catalog = JobCatalog(path)
+    try:
+        df = catalog.status()
+    finally:
+        catalog.close()
+
+    with pd.option_context('display.max_rows', None):
+        print(df.to_string(index=False))
+
+
+class JobCatalog:
+    """SQLite catalog of extracts, tarballs and members being imported
+
+    Tarballs are keyed by url, or by path for local tarballs, and members by
+    tarball and member name.
+
+    Each tarball is imported inside `importing()`. Members decoded since the
+    last flush of the writer are kept in memory, and marked written by
+    `flushed()`; pass it as the writer's `on_flush`.
+
+    ```py
+    job_catalog = JobCatalog('data/raw/_jobs.sqlite')
+    with PartitionedWriter(data_dir, on_flush=job_catalog.flushed) as writer:
+        for url in job_catalog.pending(urls):
+            with job_catalog.importing(url) as job:
+                import_tarfile(..., job=job)
+    ```
+
+    Args:
+        - path: SQLite file, created if it doesn't exist
+    """
+    def __init__(self, path):
+        Path(path).parent.mkdir(exist_ok=True, parents=True)
+        # Wait on other processes instead of failing right away if they have
+        # the file locked
+        self.conn = sqlite3.connect(path, timeout=60)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        with self.conn:
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS extracts '
+                '(extract TEXT PRIMARY KEY, state TEXT, updated TEXT)')
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS tarballs '
+                '(tarball TEXT PRIMARY KEY, extract TEXT, state TEXT, '
+                'error TEXT, updated TEXT)')
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS members '
+                '(tarball TEXT, member TEXT, state TEXT, error TEXT, '
+                'updated TEXT, PRIMARY KEY (tarball, member))')
+
+        # Items of (tarball, member), and tarballs, decoded but not yet
+        # written
+        self._decoded_members = []
+        self._decoded_tarballs = []
+
+    def close(self):
+        self.conn.close()
+
+    def add_extract(self, extract, tarballs):
+        """Record tarballs listed in extract
+
+        Tarballs already in the catalog keep their state.
+        """
+        with self.conn:
+            self.conn.execute(
+                'INSERT OR IGNORE INTO extracts VALUES (?, ?, ?)',
+                (extract, 'listed', _now()))
+        self.add_tarballs(tarballs, extract=extract)
+
+    def add_tarballs(self, tarballs, extract=None):
+        """Record tarballs, e.g. local ones that aren't part of an extract
+
+        Tarballs already in the catalog keep their state.
+        """
+        now = _now()
+        with self.conn:
+            self.conn.executemany(
+                'INSERT OR IGNORE INTO tarballs VALUES (?, ?, ?, NULL, ?)',
+                [(str(t), extract, 'listed', now) for t in tarballs])
+
+    def pending(self, tarballs):
+        """Tarballs that aren't written yet, in the given order
+        """
+        written = {
+            row[0] for row in self.conn.execute(
+                'SELECT tarball FROM tarballs WHERE state = ?', ('written',))}
+        return [t for t in tarballs if str(t) not in written]
+
+    def set_tarball_state(self, tarball, state, error=None):
+        with self.conn:
+            self.conn.execute(
+                'UPDATE tarballs SET state = ?, error = ?, updated = ? '
+                'WHERE tarball = ?', (state, error, _now(), str(tarball)))
+
+    def written_members(self, tarball):
+        """Names of members of tarball that are already written
+        """
+        rows = self.conn.execute(
+            'SELECT member FROM members WHERE tarball = ? AND state = ?',
+            (str(tarball), 'written'))
+        return {row[0] for row in rows}
+
+    def set_member_states(self, tarball, members, state, error=None):
+        now = _now()
+        with self.conn:
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO members VALUES (?, ?, ?, ?, ?)',
+                [(str(tarball), m, state, error, now) for m in members])
+
+    def tarball_failed(self, tarball, error):
+        """Print error and mark tarball failed, e.g. when it can't be
+        downloaded
+        """
+        print(f'Failed to import {tarball}: {error!r}')
+        self.set_tarball_state(tarball, 'failed', error=repr(error))
+
+    def member_decoded(self, tarball, member):
+        self._decoded_members.append((str(tarball), member))
+
+    @contextmanager
+    def importing(self, tarball):
+        """Record import of tarball in block
+
+        Yields a TarballJob. When the block finishes, the tarball is decoded,
+        and written at the next flush. If the block raises, the error is
+        printed and the tarball is marked failed, and the exception is
+        suppressed so that the remaining tarballs are still imported.
+        KeyboardInterrupt isn't suppressed.
+        """
+        tarball = str(tarball)
+        try:
+            yield TarballJob(self, tarball)
+        except Exception as e:
+            self.tarball_failed(tarball, e)
+            return
+
+        members = [m for t, m in self._decoded_members if t == tarball]
+        self.set_member_states(tarball, members, 'decoded')
+        self.set_tarball_state(tarball, 'decoded')
+        self._decoded_tarballs.append(tarball)
+
+    def flushed(self):
+        """Mark everything decoded since the last flush as written
+        """
+        now = _now()
+        with self.conn:
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO members VALUES (?, ?, ?, NULL, ?)',
+                [(t, m, 'written', now) for t, m in self._decoded_members])
+
+            for tarball in self._decoded_tarballs:
+                n_failed = self.conn.execute(
+                    'SELECT COUNT(*) FROM members WHERE tarball = ? AND '
+                    'state = ?', (tarball, 'failed')).fetchone()[0]
+                state, error = 'written', None
+                if n_failed:
+                    state, error = 'failed', f'{n_failed} members failed'
+                self.conn.execute(
+                    'UPDATE tarballs SET state = ?, error = ?, updated = ? '
+                    'WHERE tarball = ?', (state, error, now, tarball))
+
+            self._update_extracts(now)
+
+        self._decoded_members.clear()
+        self._decoded_tarballs.clear()
+
+    def _update_extracts(self, now):
+        """Mark extracts whose tarballs are all written as written
+        """
+        self.conn.execute(
+            'UPDATE extracts SET state = ?, updated = ? WHERE state != ? AND '
+            'NOT EXISTS (SELECT 1 FROM tarballs t WHERE '
+            't.extract = extracts.extract AND t.state != ?)',
+            ('written', now, 'written', 'written'))
+
+    def status(self):
+        """Count of tarballs in each state, by extract
+
+        Returns:
+            DataFrame with columns extract, state and one column per tarball
+            state
+        """
+        extracts = pd.read_sql_query(
+            'SELECT extract, state FROM extracts', self.conn)
+        tarballs = pd.read_sql_query(
+            'SELECT extract, state AS tarball_state FROM tarballs', self.conn)
+        tarballs['extract'] = tarballs['extract'].fillna('(local)')
+        counts = pd.crosstab(tarballs['extract'], tarballs['tarball_state'])
+        counts = counts.reindex(columns=STATES, fill_value=0).reset_index()
+        counts.columns.name = None
+        return extracts.merge(counts, on='extract', how='right').fillna(
+            {'state': ''})
+
+
+class TarballJob:
+    """Member states of a tarball being imported; see `JobCatalog.importing`
+
+    Attributes:
+        - written: set of names of members already written, to skip
+    """
+    def __init__(self, catalog, tarball):
+        self.catalog = catalog
+        self.tarball = tarball
+        self.written = catalog.written_members(tarball)
+
+    def listed(self, members):
+        self.catalog.set_member_states(self.tarball, members, 'listed')
+
+    def decoded(self, member):
+        """Record that member was decoded and its rows given to the writer
+        """
+        self.catalog.member_decoded(self.tarball, member)
+
+    def failed(self, member, error):
+        self.catalog.set_member_states(
+            self.tarball, [member], 'failed', error=error)
+
+
+def in_shard(name, shard):
+    """Whether tarball belongs to shard
+
+    Args:
+        - name: tarball file name, e.g. 92102_20170101.tar. Only the name is
+          used, so the same tarball is in the same shard on every machine.
+        - shard: (i, n), or None for no sharding
+    """
+    if shard is None:
+        return True
+
+    i, n = shard
+    return zlib.crc32(name.encode()) % n == i
+
+
+def parse_shard(value):
+    """Parse shard string 'i/n' into (i, n)
+
+    Shards are numbered from 0, so `--shard 0/4` through `--shard 3/4` cover
+    all tarballs.
+    """
+    i, sep, n = value.partition('/')
+    if not (sep and i.isdigit() and n.isdigit()):
+        raise ValueError(f'Shard should be i/n, e.g. 0/4, got {value}')
+
+    i, n = int(i), int(n)
+    if not 0 <= i < n:
+        raise ValueError(f'Shard index should be from 0 to {n - 1}, got {i}')
+
+    return i, n
+
+
+def _now():
+    return datetime.now(timezone.utc).isoformat(timespec='seconds')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,157 @@
+"""
+metrics.py: Per-stage timers and counters for the pipeline programs
+
+A long import can be slow in any of downloading, reading members out of
+tarballs, decoding GRIB, or writing parquet, and the progress bar alone doesn't
+tell which. Code of each stage records into the metrics of the running program:
+
+```py
+import metrics
+
+with metrics.timer('tar_read'):
+    data = f.read()
+metrics.count('member_bytes', len(data))
+```
+
+and each program's `main` writes them out when given `--metrics-json`:
+
+```json
+{"elapsed_seconds": 812.4,
+ "timers": {"decode": 640.2, "download": 95.1, ...},
+ "counters": {"members": 8064, "decode_failures": 0, "rows": 4838400, ...}}
+```
+
+Timers add up the wall time spent in a stage. Work done in worker processes is
+timed in the worker and added here by the code collecting results, so with
+several workers those timers add up time across processes, and can be larger
+than `elapsed_seconds`.
+
+Profiling is off unless a program enables it, e.g. with `--profile`; then code
+inside `profiled()` blocks is run under cProfile, and the stats written with
+`write_profile` can be read with `pstats` or `snakeviz`.
+"""
+import cProfile
+import json
+from collections import defaultdict
+from contextlib import contextmanager
+from pathlib import Path
+from time import perf_counter
+
+
+class Metrics:
+    """Wall time by stage and counts by name
+    """
+    def __init__(self):
+        self.start_time = perf_counter()
+        self.timers = defaultdict(float)
+        self.counters = defaultdict(int)
+        self.profiler = None
+
+    @contextmanager
+    def timer(self, stage):
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.timers[stage] += perf_counter() - start
+
+    def timed_iter(self, stage, iterable):
+        """Yield from iterable, adding the time spent waiting on each item to
+        stage
+        """
+        iterator = iter(iterable)
+        while True:
+            start = perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self.timers[stage] += perf_counter() - start
+            yield item
+
+    def add_time(self, stage, seconds):
+        self.timers[stage] += seconds
+
+    def count(self, name, n=1):
+        self.counters[name] += int(n)
+
+    @contextmanager
+    def profiled(self):
+        """Run block under cProfile, if profiling is enabled
+        """
+        if self.profiler is None:
+            yield
+            return
+
+        self.profiler.enable()
+        try:
+            yield
+        finally:
+            self.profiler.disable()
+
+    def to_dict(self):
+        return {
+            'elapsed_seconds': perf_counter() - self.start_time,
+            'timers': dict(sorted(self.timers.items())),
+            'counters': dict(sorted(self.counters.items())),
+        }
+
+    def write_json(self, path):
+        Path(path).write_text(json.dumps(self.to_dict(), indent=2) + '\n')
+
+
+# Metrics of the running program
+_metrics = Metrics()
+
+
+def timer(stage):
+    """Context manager adding the wall time of its block to stage
+    """
+    return _metrics.timer(stage)
+
+
+def timed_iter(stage, iterable):
+    return _metrics.timed_iter(stage, iterable)
+
+
+def add_time(stage, seconds):
+    _metrics.add_time(stage, seconds)
+
+
+def count(name, n=1):
+    _metrics.count(name, n)
+
+
+def timed_call(fn, *args, **kwargs):
+    """Call fn, e.g. in a worker process
+
+    Returns:
+        (result, seconds)
+    """
+    start = perf_counter()
+    result = fn(*args, **kwargs)
+    return result, perf_counter() - start
+
+
+def enable_profiling():
+    _metrics.profiler = cProfile.Profile()
+
+
+def profiled():
+    return _metrics.profiled()
+
+
+def write_profile(path):
+    """Write cProfile stats of all `profiled()` blocks run so far
+    """
+    assert _metrics.profiler is not None, 'Profiling was not enabled'
+    _metrics.profiler.dump_stats(path)
+
+
+def to_dict():
+    return _metrics.to_dict()
+
+
+def write_json(path):
+    _metrics.write_json(path)
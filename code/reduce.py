@@ -0,0 +1,161 @@
+"""
+reduce.py: Keep the latest forecast for each cell and valid time
+
+The reduction is done with a bounded amount of memory. When the input is too
+large to reduce at once, rows are first spilled into partitions by ranges of
+cell id, so that every (cell, valid_time) key lives in a single partition. Each
+partition is then reduced in memory. Because partitions are contiguous ranges
+of cells, writing them in order gives output sorted by cell and valid_time,
+the same as reducing everything at once.
+"""
+import math
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+import constants
+import schema
+
+# Missing values. It's 9999 in the max temp/YGU dataset, but not sure if it's
+# that in all forecast elements
+MISSING = 9999
+
+# Rough number of bytes of memory needed per row while reducing, including
+# the copies made when sorting
+BYTES_PER_ROW = 64
+
+BATCH_SIZE = 1_000_000
+
+
+def latest_forecasts(df):
+    """Keep most recent forecast for each cell and valid_time
+
+    Args:
+        - df: DataFrame in compact schema
+
+    Returns:
+        DataFrame with one row per cell-valid_time combo, sorted by cell and
+        valid_time. When fcst_time is equal, the row that comes last in df is
+        kept.
+    """
+    df = df[df['vals'] != MISSING]
+
+    # Pack (cell, valid_time) into a single int64 key, then sort by key and
+    # fcst_time and take the last row of each key
+    key = (df['cell'].values.astype(np.int64) << 32) | (
+        df['valid_time'].values.astype(np.int64) & 0xFFFFFFFF)
+    order = np.lexsort((df['fcst_time'].values, key))
+    key = key[order]
+    last = np.ones(len(key), dtype=bool)
+    last[:-1] = key[1:] != key[:-1]
+
+    return df.iloc[order[last]].reset_index(drop=True)
+
+
+def coalesce_files(
+        paths, out_path, memory_budget=2 * 1024 ** 3, row_filter=None):
+    """Reduce data files to latest forecast per cell and valid_time
+
+    Args:
+        - paths: data files to reduce, in any schema `schema.py` can read.
+          When fcst_time is equal, rows from later paths are kept.
+        - out_path: path of output parquet file, in compact schema. It's
+          only replaced once the output is complete, so it can also be one
+          of paths.
+        - memory_budget: approximate maximum bytes of memory to use
+        - row_filter: optional pyarrow.dataset Expression selecting rows of
+          paths to use
+    """
+    paths = [str(p) for p in paths]
+    n_rows = sum(pq.ParquetFile(p).metadata.num_rows for p in paths)
+    n_parts = max(math.ceil(n_rows * BYTES_PER_ROW / memory_budget), 1)
+
+    # An interrupted run leaves an existing output, e.g. one being merged
+    # into, intact
+    with schema.atomic_path(out_path) as tmp_path:
+        if n_parts == 1:
+            df = pd.concat([
+                batch for p in paths
+                for batch in schema.iter_batches(p, BATCH_SIZE, row_filter)],
+                ignore_index=True)
+            schema.write_parquet(latest_forecasts(df), tmp_path)
+            return
+
+        bounds = _partition_bounds(paths, n_parts, row_filter)
+        with TemporaryDirectory() as tempdir:
+            part_paths = _spill(paths, bounds, Path(tempdir), row_filter)
+
+            with pq.ParquetWriter(
+                    tmp_path, schema.SCHEMA,
+                    compression=schema.COMPRESSION) as writer:
+                for part_path in part_paths:
+                    if not part_path.exists():
+                        continue
+
+                    df = latest_forecasts(pd.read_parquet(part_path))
+                    writer.write_table(pa.Table.from_pandas(
+                        df, schema=schema.SCHEMA, preserve_index=False))
+                    part_path.unlink()
+
+
+def _partition_bounds(paths, n_parts, row_filter=None):
+    """Choose cell id boundaries that split rows into n_parts even partitions
+
+    Returns:
+        array of n_parts - 1 cell ids; partition i holds cells in
+        [bounds[i - 1], bounds[i])
+    """
+    counts = np.zeros(constants.height * constants.width, dtype=np.int64)
+    for path in paths:
+        for df in schema.iter_batches(path, BATCH_SIZE, row_filter):
+            counts += np.bincount(df['cell'].values, minlength=len(counts))
+
+    cumsum = np.cumsum(counts)
+    targets = cumsum[-1] * np.arange(1, n_parts) / n_parts
+    return np.searchsorted(cumsum, targets, side='right')
+
+
+def _spill(paths, bounds, tempdir, row_filter=None):
+    """Write rows of paths into one parquet file per cell partition
+    """
+    part_paths = [tempdir / f'{i}.parquet' for i in range(len(bounds) + 1)]
+    # Keep roughly one batch buffered in total across all partitions
+    max_buffered = max(BATCH_SIZE // len(part_paths), 10_000)
+    writers = {}
+    buffers = [[] for _ in part_paths]
+    buffered = [0 for _ in part_paths]
+
+    def flush(i):
+        if i not in writers:
+            writers[i] = pq.ParquetWriter(part_paths[i], schema.SCHEMA)
+        table = pa.Table.from_pandas(
+            pd.concat(buffers[i], ignore_index=True), schema=schema.SCHEMA,
+            preserve_index=False)
+        writers[i].write_table(table)
+        buffers[i] = []
+        buffered[i] = 0
+
+    try:
+        for path in paths:
+            for df in schema.iter_batches(path, BATCH_SIZE, row_filter):
+                df = df[df['vals'] != MISSING]
+                part = np.searchsorted(bounds, df['cell'].values, side='right')
+                for i in np.unique(part):
+                    chunk = df[part == i]
+                    buffers[i].append(chunk)
+                    buffered[i] += len(chunk)
+                    if buffered[i] >= max_buffered:
+                        flush(i)
+
+        for i, rows in enumerate(buffered):
+            if rows > 0:
+                flush(i)
+    finally:
+        for writer in writers.values():
+            writer.close()
+
+    return part_paths
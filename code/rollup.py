@@ -0,0 +1,299 @@
+"""
+rollup.py: Daily per-cell aggregates, and coarser rollups built from them
+
+Reading years of coalesced data is the slow part of any summary, so this reads
+each coalesced forecast element file once, in batches, and reduces it to a
+daily table with one row per cell and day:
+
+- cell, day: cell id and days since the Unix epoch of valid time
+- count, sum, sumsq, min, max: of the values valid that day
+- freezing: count of values at or below freezing, for temperature elements
+
+Days are UTC days, unless shifted with `--utc-offset`, e.g. -8 for Pacific
+standard time.
+
+Rollups by week (1 to 53, of days since January 1), half-month (1 to 24, like
+`summarize.py`) and month of year are then built from the daily tables alone,
+which takes seconds. Each rollup has columns x, y, the period, and year with
+`--by-year`, and:
+
+- count, days: values and days with values
+- mean, std, min, max: of values
+- mean_daily_min, mean_daily_max: average of the daily min and max
+- freezing_fraction: fraction of values at or below freezing, for temperature
+  elements. For hourly temperature, the fraction of freezing hours.
+- precip_days, precip_day_fraction: days with a total of at least 0.01 inches,
+  and their fraction of days, for precipitation
+
+The standard deviation is computed from sums of squares. Values are summed in
+float64, which for temperatures in K keeps about 8 significant digits of the
+variance even over millions of values.
+
+Writes to the output directory, for each forecast element:
+- `<element>.daily.parquet`: daily table
+- `<element>.<granularity>.parquet`: rollups
+
+I run this with:
+```
+python code/rollup.py -d data/coalesced -o data/rollup
+```
+and to rebuild rollups from existing daily tables, e.g. with `--by-year`:
+```
+python code/rollup.py -o data/rollup --by-year
+```
+"""
+from pathlib import Path
+
+import click
+import numpy as np
+import pandas as pd
+
+import schema
+from stats import half_month
+
+MINUTES_PER_DAY = 24 * 60
+
+# Freezing point in K, the unit of temperature elements
+FREEZING = 273.15
+TEMPERATURE_ELEMENTS = ('YE', 'YG', 'YH')
+
+# Total precipitation in mm, i.e. 0.01 inches, for a day to count as a
+# precipitation day
+PRECIP_DAY = .254
+PRECIP_ELEMENTS = ('YI',)
+
+GRANULARITIES = ['week', 'month_half', 'month']
+
+# How to combine partial aggregates of the same cell and day
+DAILY_AGGREGATIONS = {
+    'count': 'sum',
+    'sum': 'sum',
+    'sumsq': 'sum',
+    'min': 'min',
+    'max': 'max',
+    'freezing': 'sum',
+}
+
+
+@click.command()
+@click.option(
+    '-d',
+    '--data-dir',
+    required=False,
+    multiple=True,
+    type=click.Path(
+        exists=True, file_okay=False, dir_okay=True, resolve_path=True),
+    help='Path to directories of coalesced data. Without it, rollups are '
+    'built from daily tables already in out-dir.')
+@click.option(
+    '-o',
+    '--out-dir',
+    required=True,
+    type=click.Path(file_okay=False, dir_okay=True, resolve_path=True),
+    help='Directory where to save daily tables and rollups.')
+@click.option(
+    '--granularity',
+    required=False,
+    multiple=True,
+    default=GRANULARITIES,
+    show_default=True,
+    type=click.Choice(GRANULARITIES),
+    help='Rollups to build.')
+@click.option(
+    '--by-year',
+    is_flag=True,
+    default=False,
+    help='Roll up each year separately, instead of over all years.')
+@click.option(
+    '--utc-offset',
+    required=False,
+    default=0,
+    show_default=True,
+    type=click.IntRange(min=-12, max=14),
+    help='Hours from UTC of the time zone that days are in.')
+def main(data_dir, out_dir, granularity, by_year, utc_offset):
+    out_dir = Path(out_dir)
+    out_dir.mkdir(exist_ok=True, parents=True)
+
+    if data_dir:
+        files = {}
+        for d in data_dir:
+            for file in sorted(Path(d).glob('*.parquet')):
+                files.setdefault(file.stem, []).append(file)
+
+        for element, paths in files.items():
+            daily = combine_daily([
+                daily_table(path, element, utc_offset) for path in paths])
+            write_table(daily, out_dir / f'{element}.daily.parquet')
+
+    for path in sorted(out_dir.glob('*.daily.parquet')):
+        element = path.name.split('.')[0]
+        daily = pd.read_parquet(path)
+        for g in granularity:
+            df = rollup(daily, element, g, by_year=by_year)
+            write_table(df, out_dir / f'{element}.{g}.parquet')
+
+
+def daily_table(path, element, utc_offset=0):
+    """Reduce coalesced data file to daily aggregates per cell
+
+    Args:
+        - path: coalesced data file
+        - element: forecast element, e.g. yeu
+        - utc_offset: hours from UTC of the time zone of days
+
+    Returns:
+        DataFrame with columns cell, day, count, sum, sumsq, min, max, and
+        freezing for temperature elements, sorted by cell and day
+    """
+    freezing = _is_element(element, TEMPERATURE_ELEMENTS)
+    partials = [
+        daily_aggregates(df, freezing=freezing, utc_offset=utc_offset)
+        for df in schema.iter_batches(path)]
+    if not partials:
+        partials = [daily_aggregates(
+            schema.SCHEMA.empty_table().to_pandas(), freezing=freezing)]
+    return combine_daily(partials)
+
+
+def daily_aggregates(df, freezing=False, utc_offset=0):
+    """Daily aggregates of a batch of rows
+
+    Coalesced files are sorted by cell and valid time, so each (cell, day)
+    group is usually a contiguous run of rows, which is reduced with
+    `np.ufunc.reduceat`. Other batches are sorted first.
+
+    Args:
+        - df: DataFrame in compact schema
+        - freezing: whether to count values at or below freezing
+        - utc_offset: hours from UTC of the time zone of days
+
+    Returns:
+        DataFrame of aggregates, with one row per (cell, day) in df
+    """
+    minutes = df['valid_time'].values.astype(np.int64) + utc_offset * 60
+    day = minutes // MINUTES_PER_DAY
+    key = (df['cell'].values.astype(np.int64) << 32) | (day & 0xFFFFFFFF)
+    vals = df['vals'].values.astype(np.float64)
+
+    if np.any(key[1:] < key[:-1]):
+        order = np.argsort(key, kind='stable')
+        key = key[order]
+        vals = vals[order]
+
+    starts = np.flatnonzero(np.r_[len(key) > 0, key[1:] != key[:-1]])
+    out = pd.DataFrame({
+        'cell': (key[starts] >> 32).astype(np.int32),
+        'day': (key[starts] & 0xFFFFFFFF).astype(np.uint32).astype(np.int32),
+        'count': np.diff(np.r_[starts, len(key)]).astype(np.int32),
+        'sum': np.add.reduceat(vals, starts),
+        'sumsq': np.add.reduceat(vals ** 2, starts),
+        'min': np.minimum.reduceat(vals, starts).astype(np.float32),
+        'max': np.maximum.reduceat(vals, starts).astype(np.float32),
+    })
+    if freezing:
+        out['freezing'] = np.add.reduceat(
+            (vals <= FREEZING).astype(np.int32), starts).astype(np.int32)
+
+    return out
+
+
+def combine_daily(dfs):
+    """Combine partial daily aggregates, e.g. of batches or files
+
+    Groups split across batches, or present in several files, are merged.
+    """
+    df = pd.concat(dfs, ignore_index=True)
+    if not df.duplicated(['cell', 'day']).any():
+        return df.sort_values(['cell', 'day'], ignore_index=True)
+
+    aggs = {c: a for c, a in DAILY_AGGREGATIONS.items() if c in df}
+    return df.groupby(['cell', 'day'], as_index=False, sort=True).agg(aggs)
+
+
+def rollup(daily, element, granularity, by_year=False):
+    """Roll up daily table to a coarser period of the year
+
+    Args:
+        - daily: daily table from `daily_table`
+        - element: forecast element, e.g. yeu
+        - granularity: one of GRANULARITIES
+        - by_year: whether to keep years separate
+
+    Returns:
+        DataFrame with one row per cell and period, see module docstring
+    """
+    dates = daily['day'].values.astype('datetime64[D]')
+    keys = {'cell': daily['cell'].values}
+    if by_year:
+        keys['year'] = dates.astype('datetime64[Y]').astype(np.int64) + 1970
+    keys[granularity] = period_of_year(dates, granularity)
+
+    df = daily.assign(**keys)
+    aggs = {
+        'count': ('count', 'sum'),
+        'days': ('count', 'size'),
+        'sum': ('sum', 'sum'),
+        'sumsq': ('sumsq', 'sum'),
+        'min': ('min', 'min'),
+        'max': ('max', 'max'),
+        'mean_daily_min': ('min', 'mean'),
+        'mean_daily_max': ('max', 'mean'),
+    }
+    if 'freezing' in daily:
+        aggs['freezing'] = ('freezing', 'sum')
+    if _is_element(element, PRECIP_ELEMENTS):
+        df['precip_day'] = df['sum'] >= PRECIP_DAY
+        aggs['precip_days'] = ('precip_day', 'sum')
+
+    out = df.groupby(list(keys), as_index=False, sort=True).agg(**aggs)
+
+    count = out['count'].values.astype(np.float64)
+    out['mean'] = out['sum'] / count
+    with np.errstate(invalid='ignore', divide='ignore'):
+        var = (out['sumsq'] - out['sum'] ** 2 / count) / (count - 1)
+    out['std'] = np.where(count > 1, np.sqrt(np.maximum(var, 0)), np.nan)
+    if 'freezing' in out:
+        out['freezing_fraction'] = out.pop('freezing') / count
+    if 'precip_days' in out:
+        out['precip_day_fraction'] = out['precip_days'] / out['days']
+
+    x, y = schema.cell_xy(out.pop('cell').values)
+    out.insert(0, 'x', x)
+    out.insert(1, 'y', y)
+    columns = [
+        'x', 'y', *list(keys)[1:], 'count', 'days', 'mean', 'std', 'min',
+        'max', 'mean_daily_min', 'mean_daily_max']
+    derived = [
+        c for c in ['freezing_fraction', 'precip_days', 'precip_day_fraction']
+        if c in out]
+    return out[columns + derived]
+
+
+def period_of_year(dates, granularity):
+    """Period of the year, starting at 1, of datetime64[D] dates
+    """
+    if granularity == 'month':
+        return dates.astype('datetime64[M]').astype(np.int64) % 12 + 1
+
+    if granularity == 'month_half':
+        return half_month(dates.astype('datetime64[m]').astype(np.int64))
+
+    if granularity == 'week':
+        year_start = dates.astype('datetime64[Y]').astype('datetime64[D]')
+        return (dates - year_start).astype(np.int64) // 7 + 1
+
+    raise ValueError(f'Unknown granularity {granularity}')
+
+
+def write_table(df, path):
+    with schema.atomic_path(path) as tmp_path:
+        df.to_parquet(tmp_path, index=False, compression=schema.COMPRESSION)
+
+
+def _is_element(element, prefixes):
+    return element.upper().startswith(prefixes)
+
+
+if __name__ == '__main__':
+    main()
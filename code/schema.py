@@ -0,0 +1,174 @@
+"""
+schema.py: Compact on-disk schema shared by import, coalesce and summarize
+
+Rows are stored with columns:
+
+- cell: int32 cell id, `x * constants.width + y`
+- vals: float32 forecast value
+- fcst_time: int32 minutes since the Unix epoch of when forecast was made
+- valid_time: int32 minutes since the Unix epoch of when forecast is valid for
+
+Files are zstd compressed, and rows are sorted by cell and time so that row
+group statistics can be used to skip data.
+
+`expand` converts back to the original columns: x, y, vals, fcst_time,
+valid_time, with datetime64 times.
+"""
+from contextlib import contextmanager
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+import constants
+
+SCHEMA = pa.schema([
+    ('cell', pa.int32()),
+    ('vals', pa.float32()),
+    ('fcst_time', pa.int32()),
+    ('valid_time', pa.int32()),
+])
+SORT_COLUMNS = ['cell', 'valid_time', 'fcst_time']
+COMPRESSION = 'zstd'
+
+EXPANDED_COLUMNS = ['x', 'y', 'vals', 'fcst_time', 'valid_time']
+TIME_COLUMNS = ['fcst_time', 'valid_time']
+
+
+def cell_id(x, y):
+    """Cell id from NDFD grid x (row) and y (column) indices
+    """
+    return (np.asarray(x) * constants.width + np.asarray(y)).astype(np.int32)
+
+
+def cell_xy(cell):
+    """NDFD grid x (row) and y (column) indices from cell id
+    """
+    return np.divmod(np.asarray(cell, dtype=np.int64), constants.width)
+
+
+def to_epoch_minutes(times):
+    """Convert datetime-like array to int32 minutes since the epoch
+    """
+    times = np.asarray(times, dtype='datetime64[m]')
+    return times.astype(np.int64).astype(np.int32)
+
+
+def from_epoch_minutes(minutes):
+    """Convert int32 minutes since the epoch to datetime64
+    """
+    return np.asarray(minutes, dtype=np.int64).astype('datetime64[m]')
+
+
+def compact(df):
+    """Convert DataFrame with expanded columns to compact DataFrame
+    """
+    return pd.DataFrame({
+        'cell': cell_id(df['x'].values, df['y'].values),
+        'vals': df['vals'].values.astype(np.float32),
+        'fcst_time': to_epoch_minutes(df['fcst_time'].values),
+        'valid_time': to_epoch_minutes(df['valid_time'].values),
+    })
+
+
+def expand(df):
+    """Convert compact DataFrame to expanded columns
+
+    Columns other than those of the compact schema are kept as is.
+    """
+    df = df.copy()
+    x, y = cell_xy(df.pop('cell').values)
+    df.insert(0, 'x', x)
+    df.insert(1, 'y', y)
+    for col in TIME_COLUMNS:
+        if col in df:
+            df[col] = pd.to_datetime(from_epoch_minutes(df[col].values))
+    return df
+
+
+def sort_table(table):
+    """Sort pyarrow Table by cell and time
+    """
+    return table.sort_by([(col, 'ascending') for col in SORT_COLUMNS])
+
+
+def write_parquet(df, path, **kwargs):
+    """Write compact DataFrame to parquet, sorted by cell and time
+    """
+    table = pa.Table.from_pandas(df, schema=SCHEMA, preserve_index=False)
+    pq.write_table(sort_table(table), path, compression=COMPRESSION, **kwargs)
+
+
+@contextmanager
+def atomic_path(path):
+    """Temporary path to write to, renamed to path when the block completes
+
+    An interrupted write never leaves a truncated file at path, e.g. one that
+    looks like part of a dataset, or one in place of a complete output. The
+    temporary name starts with a dot, so it's skipped when listing data files,
+    and it's removed if the block raises.
+
+    ```py
+    with schema.atomic_path(out_path) as tmp_path:
+        df.to_parquet(tmp_path)
+    ```
+    """
+    path = Path(path)
+    tmp_path = path.with_name(f'.{path.name}.tmp')
+    try:
+        yield tmp_path
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+
+    tmp_path.replace(path)
+
+
+def read_parquet(path, expanded=False):
+    """Read data file into compact DataFrame
+
+    Files written before the compact schema, i.e. with x and y columns, are
+    converted on read.
+
+    Args:
+        - path: path to parquet file
+        - expanded: if True, return expanded columns instead
+    """
+    df = pd.read_parquet(path)
+    if 'cell' not in df:
+        df = compact(df)
+
+    if expanded:
+        return expand(df)
+
+    return df
+
+
+def iter_batches(path, batch_size=1_000_000, row_filter=None):
+    """Iterate over data file in compact DataFrames of at most batch_size rows
+
+    Args:
+        - path: path to parquet file
+        - batch_size: maximum rows per DataFrame
+        - row_filter: optional pyarrow.dataset Expression on compact columns.
+          Row groups whose statistics don't match are skipped without being
+          read.
+    """
+    dataset = ds.dataset(path, format='parquet')
+    if 'cell' in dataset.schema.names:
+        for batch in dataset.to_batches(
+                filter=row_filter, batch_size=batch_size):
+            yield batch.to_pandas()
+        return
+
+    # Older files need to be converted before they can be filtered
+    for batch in dataset.to_batches(batch_size=batch_size):
+        df = compact(batch.to_pandas())
+        if row_filter is not None:
+            table = pa.Table.from_pandas(
+                df, schema=SCHEMA, preserve_index=False)
+            df = table.filter(row_filter).to_pandas()
+        yield df
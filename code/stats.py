@@ -0,0 +1,290 @@
+"""
+stats.py: Mergeable per-cell, per-half-month accumulators
+
+Statistics are accumulated in dense NumPy arrays indexed by (cell, half-month),
+updated one batch of rows at a time with `np.bincount`. Accumulators of the
+same cells can be merged, so that shards or years can be summarized
+independently and combined afterwards.
+"""
+import numpy as np
+
+import schema
+
+# Number of half-month bins in a year
+N_BINS = 24
+
+
+def half_month(minutes):
+    """Half-month bin, 1 to 24, of times in minutes since the epoch
+
+    A day is in the first half of the month when day / days_in_month <= .5.
+    """
+    times = schema.from_epoch_minutes(minutes)
+    month_start = times.astype('datetime64[M]')
+    month = month_start.astype(np.int64) % 12 + 1
+
+    start_day = month_start.astype('datetime64[D]')
+    day = (times.astype('datetime64[D]') - start_day).astype(np.int64) + 1
+    days_in_month = (
+        (month_start + 1).astype('datetime64[D]') - start_day).astype(np.int64)
+
+    first_half = day / days_in_month <= .5
+    return 2 * month - first_half
+
+
+class CellIndex:
+    """Map cell ids to dense indices 0 to n - 1
+
+    Args:
+        - cells: cell ids, e.g. of the grid
+    """
+    def __init__(self, cells):
+        self.cells = np.unique(np.asarray(cells, dtype=np.int32))
+
+    def __len__(self):
+        return len(self.cells)
+
+    def lookup(self, cells):
+        """Dense index of each cell id, or -1 if cell isn't in the index
+        """
+        cells = np.asarray(cells)
+        idx = np.searchsorted(self.cells, cells)
+        idx[idx == len(self.cells)] = 0
+        found = self.cells[idx] == cells
+        return np.where(found, idx, -1)
+
+    def bin_index(self, cells, minutes):
+        """Flat index into (cell, half-month) arrays for each row
+
+        Rows of cells not in the index get -1.
+        """
+        idx = self.lookup(cells)
+        flat = idx * N_BINS + half_month(minutes) - 1
+        return np.where(idx >= 0, flat, -1)
+
+
+class Moments:
+    """Count, mean and sum of squared deviations (M2) per (cell, half-month)
+
+    Batches are combined with the parallel form of Welford's algorithm, so
+    results don't depend on how rows are split into batches or accumulators.
+
+    Args:
+        - cells: cell ids, in the order of the first axis of the arrays
+    """
+    def __init__(self, cells):
+        self.cells = np.asarray(cells, dtype=np.int32)
+        shape = (len(self.cells), N_BINS)
+        self.count = np.zeros(shape)
+        self.mean = np.zeros(shape)
+        self.m2 = np.zeros(shape)
+
+    def update(self, index, vals):
+        """Add values at flat (cell, half-month) indices from `bin_index`
+        """
+        keep = index >= 0
+        index = index[keep]
+        vals = np.asarray(vals, dtype=np.float64)[keep]
+
+        size = self.count.size
+        count = np.bincount(index, minlength=size).astype(np.float64)
+        total = np.bincount(index, weights=vals, minlength=size)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = np.where(count > 0, total / count, 0)
+        m2 = np.bincount(
+            index, weights=(vals - mean[index]) ** 2, minlength=size)
+
+        shape = self.count.shape
+        self._combine(
+            count.reshape(shape), mean.reshape(shape), m2.reshape(shape))
+
+    def merge(self, other):
+        """Add statistics of another accumulator of the same cells
+        """
+        msg = 'Accumulators must be of the same cells'
+        assert np.array_equal(self.cells, other.cells), msg
+        self._combine(other.count, other.mean, other.m2)
+
+    def _combine(self, count, mean, m2):
+        total = self.count + count
+        delta = mean - self.mean
+        with np.errstate(invalid='ignore', divide='ignore'):
+            frac = np.where(total > 0, count / total, 0)
+        self.mean = self.mean + delta * frac
+        self.m2 = self.m2 + m2 + delta ** 2 * self.count * frac
+        self.count = total
+
+    @property
+    def std(self):
+        """Sample standard deviation, NaN where there are fewer than 2 values
+        """
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(
+                self.count > 1, np.sqrt(self.m2 / (self.count - 1)), np.nan)
+
+    def save(self, path):
+        np.savez_compressed(
+            path, cells=self.cells, count=self.count, mean=self.mean,
+            m2=self.m2)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            moments = cls(data['cells'])
+            moments.count = data['count']
+            moments.mean = data['mean']
+            moments.m2 = data['m2']
+        return moments
+
+
+# Fixed histogram bins (low, high, width) for each forecast element, by first
+# two letters of the element code. Units are those of the GRIB files.
+HISTOGRAM_BINS = {
+    # Hourly, max and min temperature, K
+    'YE': (200, 340, .5),
+    'YG': (200, 340, .5),
+    'YH': (200, 340, .5),
+    # 12-hour probability of precipitation, %
+    'YD': (0, 101, 1),
+    # Quantitative precipitation forecast, kg/m^2 (i.e. mm). Bins are 0.01 in.
+    'YI': (0, 50.8, .254),
+    # Wind speed, m/s
+    'YC': (0, 50, .25),
+}
+
+
+class Histogram:
+    """Fixed-bin histogram of values per (cell, half-month)
+
+    Histograms are built in one pass and can be merged exactly, unlike
+    quantiles. Quantiles and exceedance probabilities are then estimated from
+    the histogram:
+
+    - `quantile` interpolates linearly within the bin holding the quantile.
+      For values within [low, high), the estimate is within one bin width of
+      the two sample values that the exact quantile (as computed by pandas,
+      with linear interpolation) lies between. With many values per cell and
+      half-month, those are close, so the error is at most about one bin
+      width.
+    - `exceedance` is exact when the threshold is a bin edge; otherwise the
+      count of the bin holding the threshold is split linearly.
+
+    Values outside [low, high) are counted in the first or last bin, so
+    quantiles falling in those bins are only bounded by the bin edge.
+
+    Memory use is 4 bytes per cell, half-month and bin, and is allocated up
+    front for all cells: 26,880 bytes per cell for the 280 bins of a
+    temperature element, i.e. about 1.3 GB for a grid of 50,000 cells. Saved
+    histograms are compressed and much smaller, since most bins are empty.
+
+    Args:
+        - cells: cell ids, in the order of the first axis of the arrays
+        - low, high, width: range and width of bins
+    """
+    def __init__(self, cells, low, high, width):
+        self.cells = np.asarray(cells, dtype=np.int32)
+        self.low = low
+        self.high = high
+        self.width = width
+        self.n_bins = int(np.ceil((high - low) / width - 1e-9))
+        self.counts = np.zeros(
+            (len(self.cells), N_BINS, self.n_bins), dtype=np.uint32)
+
+    @classmethod
+    def for_element(cls, cells, element):
+        """Histogram with bins for forecast element, e.g. YEU, or None if there
+        are no bins defined for it
+        """
+        bins = HISTOGRAM_BINS.get(element.upper()[:2])
+        if bins is None:
+            return None
+        return cls(cells, *bins)
+
+    def update(self, index, vals):
+        """Add values at flat (cell, half-month) indices from `bin_index`
+        """
+        keep = index >= 0
+        index = index[keep]
+        vals = np.asarray(vals, dtype=np.float64)[keep]
+
+        # Values are float32, so values on a bin edge, e.g. precipitation in
+        # multiples of 0.01 in, can be rounded just below it. Put them in the
+        # bin above the edge.
+        pos = (vals - self.low) / self.width + 1e-4
+        value_bin = np.floor(pos).astype(np.int64)
+        value_bin = np.clip(value_bin, 0, self.n_bins - 1)
+
+        # A dense bincount would allocate the full histogram for every batch,
+        # so only count the bins that occur
+        flat, counts = np.unique(
+            index * self.n_bins + value_bin, return_counts=True)
+        self.counts.reshape(-1)[flat] += counts.astype(np.uint32)
+
+    def merge(self, other):
+        """Add counts of another histogram of the same cells and bins
+        """
+        msg = 'Histograms must be of the same cells and bins'
+        assert np.array_equal(self.cells, other.cells), msg
+        assert (self.low, self.high, self.width) == (
+            other.low, other.high, other.width), msg
+        self.counts += other.counts
+
+    def quantile(self, q):
+        """Estimate quantile q, 0 to 1, per (cell, half-month)
+
+        Returns:
+            array of shape (n_cells, N_BINS); NaN where there are no values
+        """
+        counts = self.counts.astype(np.float64)
+        cum = counts.cumsum(axis=-1)
+        total = cum[..., -1:]
+
+        # Rank of the quantile among the sorted values, 0-indexed, and the
+        # bin that holds the value of that rank
+        rank = q * (total - 1)
+        b = (cum <= rank).sum(axis=-1, keepdims=True)
+        b = np.minimum(b, self.n_bins - 1)
+
+        before = np.take_along_axis(cum, b, axis=-1) - np.take_along_axis(
+            counts, b, axis=-1)
+        in_bin = np.take_along_axis(counts, b, axis=-1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            frac = (rank - before + .5) / in_bin
+        value = self.low + self.width * (b + np.clip(frac, 0, 1))
+
+        return np.where(total > 0, value, np.nan)[..., 0]
+
+    def exceedance(self, threshold):
+        """Estimate fraction of values >= threshold per (cell, half-month)
+
+        Returns:
+            array of shape (n_cells, N_BINS); NaN where there are no values
+        """
+        counts = self.counts.astype(np.float64)
+        total = counts.sum(axis=-1)
+
+        pos = np.clip((threshold - self.low) / self.width, 0, self.n_bins)
+        if np.isclose(pos, round(pos)):
+            pos = round(pos)
+        b = int(np.floor(pos))
+        above = counts[..., b:].sum(axis=-1)
+        if b < self.n_bins:
+            # Part of the bin holding the threshold that's above it
+            above -= counts[..., b] * (pos - b)
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(total > 0, above / total, np.nan)
+
+    def save(self, path):
+        # Most bins of a cell and half-month are empty, so counts compress
+        # well
+        np.savez_compressed(
+            path, cells=self.cells, counts=self.counts,
+            bins=np.array([self.low, self.high, self.width]))
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            hist = cls(data['cells'], *data['bins'].tolist())
+            hist.counts = data['counts']
+        return hist
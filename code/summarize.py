@@ -1,37 +1,204 @@
 """
 summarize.py: Given cleaned data, create summary stats for each cell
+
+For each coalesced forecast element file, e.g. `yeu.parquet`, compute the
+count, mean and standard deviation of values for every grid cell and half-month
+of the year. Files are streamed one row group batch at a time into the
+accumulators of `stats.py`, so memory use doesn't depend on file size.
+
+For elements with histogram bins defined in `stats.HISTOGRAM_BINS`, the 10th,
+50th and 90th percentiles are estimated from a fixed-bin histogram, to within
+one bin width. For precipitation (YI), the fraction of forecasts with at least
+0.01, 0.1, 0.25 and 0.5 inches is computed too.
+
+Histograms of all elements are held in memory until the end, at 4 bytes per
+cell, half-month and bin (see `stats.Histogram`). That's about 130 KB per cell
+for all elements, or 6.4 GB for a grid of 50,000 cells. For larger grids, split
+the grid into several files and summarize each one separately.
+
+Writes to the output directory, for each forecast element:
+- `<element>.parquet`: columns x, y, month_half, count, mean, std, and p10,
+  p50, p90 and exceed_<mm> columns when available
+- `<element>.moments.npz` and `<element>.histogram.npz`: accumulators, which
+  can be passed back in with `--partial` to combine them with summaries of
+  other shards or years
+- `cube/`: all statistics of all elements as one memory-mapped array, for fast
+  queries by location; see `cube.py`
+
+I run this with:
+```
+python code/summarize.py -g grid.geojson -d data/coalesced -o data/final
+```
 """
 from pathlib import Path
 
+import click
 import geopandas as gpd
 import numpy as np
 import pandas as pd
 
-data_dir = Path('../data/coalesced')
-out_dir = Path('../data/final')
-grid = '../grid.geojson'
+import cube
+import schema
+from stats import N_BINS, CellIndex, Histogram, Moments
+
+QUANTILES = [.1, .5, .9]
+
+# Precipitation thresholds in mm, i.e. 0.01, 0.1, 0.25 and 0.5 inches. These
+# are bin edges of the YI histogram, so exceedance fractions are exact.
+PRECIP_THRESHOLDS = [.254, 2.54, 6.35, 12.7]
+
+# Accumulator classes by file name suffix
+ACCUMULATORS = {'moments': Moments, 'histogram': Histogram}
+
+
+@click.command()
+@click.option(
+    '-g',
+    '--grid-path',
+    required=True,
+    type=click.Path(
+        exists=True, file_okay=True, dir_okay=False, resolve_path=True),
+    help='Path to grid GeoJSON file.')
+@click.option(
+    '-d',
+    '--data-dir',
+    required=False,
+    multiple=True,
+    type=click.Path(
+        exists=True, file_okay=False, dir_okay=True, resolve_path=True),
+    help='Path to directories of coalesced data.')
+@click.option(
+    '-p',
+    '--partial',
+    required=False,
+    multiple=True,
+    type=click.Path(
+        exists=True, file_okay=True, dir_okay=False, resolve_path=True),
+    help='Accumulator saved by an earlier run, e.g. yeu.moments.npz or '
+    'yeu.histogram.npz.')
+@click.option(
+    '-o',
+    '--out-dir',
+    required=True,
+    type=click.Path(file_okay=False, dir_okay=True, resolve_path=True),
+    help='Directory where to save summaries.')
+def main(grid_path, data_dir, partial, out_dir):
+    grid = gpd.read_file(grid_path)
+    cell_index = CellIndex(schema.cell_id(grid['x'], grid['y']))
+
+    # Accumulators for each forecast element, keyed by (element, kind)
+    accumulators = {}
+    for path in partial:
+        element, kind = Path(path).name.split('.')[:2]
+        merge_into(
+            accumulators, (element, kind), ACCUMULATORS[kind].load(path))
+
+    for d in data_dir:
+        for file in sorted(Path(d).glob('*.parquet')):
+            for kind, acc in summarize_file(file, cell_index).items():
+                merge_into(accumulators, (file.stem, kind), acc)
+
+    out_dir = Path(out_dir)
+    out_dir.mkdir(exist_ok=True, parents=True)
+    for (element, kind), acc in accumulators.items():
+        acc.save(out_dir / f'{element}.{kind}.npz')
+
+    stats_by_element = {}
+    for (element, kind), moments in accumulators.items():
+        if kind != 'moments':
+            continue
+
+        msg = 'All elements must be summarized over the same cells'
+        assert np.array_equal(moments.cells, cell_index.cells), msg
+
+        stats = element_stats(
+            moments, accumulators.get((element, 'histogram')), element)
+        stats_to_df(moments.cells, stats).to_parquet(
+            out_dir / f'{element}.parquet', index=False)
+        stats_by_element[element] = stats
+
+    if stats_by_element:
+        cube.write(out_dir / 'cube', cell_index.cells, stats_by_element)
+
+
+def summarize_file(path, cell_index):
+    """Accumulate statistics of coalesced data file
+
+    Args:
+        - path: coalesced data file
+        - cell_index: CellIndex of grid cells. Rows of other cells are ignored.
+
+    Returns:
+        dict of accumulators, by kind: `moments`, and `histogram` when the
+        element has histogram bins
+    """
+    accumulators = {'moments': Moments(cell_index.cells)}
+    hist = Histogram.for_element(cell_index.cells, path.stem)
+    if hist is not None:
+        accumulators['histogram'] = hist
+
+    for df in schema.iter_batches(path):
+        index = cell_index.bin_index(
+            df['cell'].values, df['valid_time'].values)
+        for acc in accumulators.values():
+            acc.update(index, df['vals'].values)
+
+    return accumulators
+
+
+def merge_into(accumulators, key, acc):
+    if key in accumulators:
+        accumulators[key].merge(acc)
+    else:
+        accumulators[key] = acc
+
+
+def element_stats(moments, hist=None, element=None):
+    """Summary statistics of forecast element
+
+    Args:
+        - moments: Moments accumulator
+        - hist: optional Histogram of the same cells, to add percentiles
+        - element: forecast element, e.g. yiu; precipitation gets exceedance
+          statistics
+
+    Returns:
+        dict of arrays of shape (n_cells, N_BINS), by statistic name
+    """
+    stats = {
+        'count': moments.count,
+        'mean': moments.mean,
+        'std': moments.std,
+    }
+    if hist is not None:
+        for q in QUANTILES:
+            stats[f'p{round(q * 100)}'] = hist.quantile(q)
 
+        if element.upper().startswith('YI'):
+            for threshold in PRECIP_THRESHOLDS:
+                stats[f'exceed_{threshold}'] = hist.exceedance(threshold)
 
-def main(data_dir, out_dir, grid):
-    files = data_dir.glob('*.parquet')
-    grid = gpd.read_file(grid)
+    return stats
 
-    for file in files:
-        df = pd.read_parquet(file)
 
-        # Bin valid_time into half-months
-        df['month'] = df['valid_time'].dt.month
-        df['first_half'] = (
-            df['valid_time'].dt.day / df['valid_time'].dt.days_in_month <= .5)
-        df['month_half'] = 2 * df['month'] - df['first_half']
+def stats_to_df(cells, stats):
+    """DataFrame with one row for each x-y-halfmonth that has data
 
-        # Create aggregated DataFrame for each x/y/half-month
-        # I.e. after aggregation there's one row for each x-y-halfmonth
-        agg = df.groupby(['x', 'y', 'month_half'])['vals'].agg([
-            np.mean, np.std]).reset_index()
+    Args:
+        - cells: cell ids, in the order of the first axis of stats arrays
+        - stats: dict of statistics from `element_stats`
+    """
+    x, y = schema.cell_xy(cells)
+    df = pd.DataFrame({
+        'x': np.repeat(x, N_BINS),
+        'y': np.repeat(y, N_BINS),
+        'month_half': np.tile(np.arange(1, N_BINS + 1), len(cells)),
+    })
+    for name, arr in stats.items():
+        df[name] = arr.ravel()
 
-        # Merge with GeoJSON grid
-        merged = agg.merge(grid, on=['x', 'y'])
+    df['count'] = df['count'].astype(np.int64)
+    return df[df['count'] > 0].reset_index(drop=True)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,94 @@
+"""
+windows.py: Plan which raster windows to read to cover a set of grid cells
+
+Reading one window spanning the min/max of all cells is simple, but for a long,
+thin grid like a trail it covers mostly cells that are thrown away. Here cells
+are grouped into horizontal strips of consecutive rows, choosing the strips that
+minimize the estimated cost of cells read plus a fixed overhead per read. When
+cells are compact, the best plan is a single strip, i.e. the bounding window.
+
+Note that GDAL's GRIB driver decodes a whole band on first access regardless
+of window, so the savings are in copying and memory rather than in decoding.
+"""
+from collections import namedtuple
+
+import numpy as np
+from rasterio.windows import Window
+
+# Estimated fixed cost of a single windowed read, in units of cells read
+READ_OVERHEAD = 4096
+
+WindowRead = namedtuple('WindowRead', ['window', 'index', 'rows', 'cols'])
+WindowRead.__doc__ = """Single windowed read and the cells to take from it
+
+- window: rasterio Window to read
+- index: positions of these cells in the original cell arrays
+- rows: row indices of these cells, relative to window
+- cols: column indices of these cells, relative to window
+"""
+
+
+def plan_windows(rows, cols, read_overhead=READ_OVERHEAD):
+    """Plan windowed reads covering the given cells
+
+    Args:
+        - rows: row indices of cells, i.e. the `x` column of the grid
+        - cols: column indices of cells, i.e. the `y` column of the grid
+        - read_overhead: estimated cost of a single read, in cells
+
+    Returns:
+        list of WindowRead, together covering every cell exactly once
+    """
+    rows = np.asarray(rows)
+    cols = np.asarray(cols)
+
+    # Column extent of each distinct row
+    order = np.argsort(rows, kind='stable')
+    uniq_rows, starts = np.unique(rows[order], return_index=True)
+    col_min = np.minimum.reduceat(cols[order], starts)
+    col_max = np.maximum.reduceat(cols[order], starts)
+
+    # Split the sorted rows into consecutive strips, choosing the split that
+    # minimizes cells read plus per-read overhead. best[j] is the cost of
+    # covering the first j rows; for each end row, the cost of every possible
+    # start row is computed at once from running column min/max.
+    n_rows = len(uniq_rows)
+    best = np.zeros(n_rows + 1)
+    best_start = np.zeros(n_rows, dtype=int)
+    for j in range(n_rows):
+        strip_cmin = np.minimum.accumulate(col_min[j::-1])[::-1]
+        strip_cmax = np.maximum.accumulate(col_max[j::-1])[::-1]
+        height = uniq_rows[j] - uniq_rows[:j + 1] + 1
+        area = height * (strip_cmax - strip_cmin + 1)
+        costs = best[:j + 1] + area + read_overhead
+        best_start[j] = np.argmin(costs)
+        best[j + 1] = costs[best_start[j]]
+
+    # Walk back through the chosen splits. Strips are [row_start, row_stop,
+    # col_start, col_stop], inclusive.
+    strips = []
+    j = n_rows - 1
+    while j >= 0:
+        i = best_start[j]
+        strips.append([
+            uniq_rows[i], uniq_rows[j], col_min[i:j + 1].min(),
+            col_max[i:j + 1].max()])
+        j = i - 1
+    strips.reverse()
+
+    # Assign each cell to the strip containing its row
+    strip_starts = np.array([s[0] for s in strips])
+    strip_idx = np.searchsorted(strip_starts, rows, side='right') - 1
+
+    plan = []
+    for i, (row_start, row_stop, col_start, col_stop) in enumerate(strips):
+        index = np.flatnonzero(strip_idx == i)
+        window = Window.from_slices(
+            (int(row_start), int(row_stop) + 1),
+            (int(col_start), int(col_stop) + 1))
+        plan.append(WindowRead(
+            window=window, index=index, rows=rows[index] - row_start,
+            cols=cols[index] - col_start))
+
+    return plan
+
@@ -0,0 +1,116 @@
+"""
+writer.py: Write extracted cell values to a partitioned parquet dataset
+
+Each GRIB message only contributes a few hundred rows, so writing one parquet
+file per message creates a huge number of tiny files. Instead, rows are
+buffered in memory as Arrow record batches and flushed as large row groups into
+a hive-partitioned dataset:
+
+```
+data_dir/element=YEU/year=2015/month=01/part-<uuid>.parquet
+```
+
+where `year` and `month` are those of the forecast (reference) time. Rows are
+stored in the compact schema defined in `schema.py`. Every file written is
+recorded in the data directory's catalog; see `catalog.py`.
+
+Time spent converting rows and writing files is recorded in `metrics` as
+`write_buffer` and `parquet_write`, with counts of files and bytes written.
+"""
+import uuid
+from collections import defaultdict
+from pathlib import Path
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+import catalog
+import metrics
+import schema
+
+
+class PartitionedWriter:
+    """Buffer rows and write them as large parquet files partitioned by
+    element/year/month
+
+    Use as a context manager, so that buffered rows are flushed when the
+    import finishes or is interrupted:
+
+    ```py
+    with PartitionedWriter(data_dir) as writer:
+        writer.write('YEUZ98_KWBN_201701010519', df)
+    ```
+
+    Args:
+        - data_dir: root of the dataset
+        - max_rows: flush once this many rows are buffered across all
+          partitions. This is also the row group size of written files.
+        - on_flush: optional function called with no arguments after each
+          flush, once buffered rows are on disk
+    """
+    def __init__(self, data_dir, max_rows=2_000_000, on_flush=None):
+        self.data_dir = Path(data_dir)
+        self.max_rows = max_rows
+        self.on_flush = on_flush
+        self._batches = defaultdict(list)
+        self._n_rows = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.flush()
+
+    def write(self, name, df):
+        """Buffer rows extracted from a single GRIB message
+
+        Args:
+            - name: name of GRIB member, e.g. YEUZ98_KWBN_201701010519. The
+              first three characters are the forecast element.
+            - df: DataFrame with columns x, y, vals, fcst_time, valid_time. All
+              rows should have the same fcst_time.
+        """
+        fcst_time = df['fcst_time'].iloc[0]
+        key = (name[:3], fcst_time.year, fcst_time.month)
+
+        with metrics.timer('write_buffer'):
+            batch = pa.RecordBatch.from_pandas(
+                schema.compact(df), schema=schema.SCHEMA, preserve_index=False)
+        self._batches[key].append(batch)
+        self._n_rows += batch.num_rows
+
+        if self._n_rows >= self.max_rows:
+            self.flush()
+
+    def flush(self):
+        """Write all buffered rows to disk
+        """
+        entries = []
+        with metrics.timer('parquet_write'):
+            for key, batches in self._batches.items():
+                entries.append(
+                    self._write_partition(key, pa.Table.from_batches(batches)))
+
+            catalog.append(self.data_dir, entries)
+        self._batches.clear()
+        self._n_rows = 0
+        if self.on_flush is not None:
+            self.on_flush()
+
+    def _write_partition(self, key, table):
+        element, year, month = key
+        part_dir = (
+            self.data_dir / f'element={element}' / f'year={year}' /
+            f'month={month:02d}')
+        part_dir.mkdir(exist_ok=True, parents=True)
+
+        path = part_dir / f'part-{uuid.uuid4().hex}.parquet'
+        with schema.atomic_path(path) as tmp_path:
+            pq.write_table(
+                schema.sort_table(table), tmp_path,
+                row_group_size=self.max_rows, compression=schema.COMPRESSION)
+        metrics.count('files_written')
+        metrics.count('bytes_written', path.stat().st_size)
+
+        return catalog.entry(
+            self.data_dir, path, element, year, month, table=table)
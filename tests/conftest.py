@@ -0,0 +1,8 @@
+import sys
+from pathlib import Path
+
+# Scripts in code/ import each other as top-level modules, and tests use the
+# fixture generator in benchmarks/
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT / 'benchmarks'))
+sys.path.insert(0, str(ROOT / 'code'))
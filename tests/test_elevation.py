@@ -0,0 +1,114 @@
+import asyncio
+import threading
+from collections import Counter
+
+import numpy as np
+import pytest
+from aiohttp import web
+
+import elevation
+import metrics
+
+# Points of the stand-in API: (lon, lat) and elevation, None for a forecast
+# without one, or 'outside' for a point outside the US
+POINTS = {
+    (-105.0, 40.0): 1600.5,
+    (-119.5, 37.8): 2400.0,
+    (-100.0, 55.0): 'outside',
+    (-90.0, 30.0): None,
+}
+# Forecast requests answered with a 503 the first time
+FLAKY = {'40.0000,-105.0000'}
+
+
+class StandInAPI:
+    """Local stand-in for the /points and forecast endpoints of the NWS API,
+    run in its own thread
+
+    Attributes:
+        - url: root url, to pass as api_url
+        - requests: count of requests by path
+    """
+    def __init__(self):
+        self.requests = Counter()
+        self._loop = asyncio.new_event_loop()
+        thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+        thread.start()
+        self.url = asyncio.run_coroutine_threadsafe(
+            self._start(), self._loop).result()
+
+    async def _start(self):
+        app = web.Application()
+        app.router.add_get('/points/{coords}', self.points)
+        app.router.add_get('/forecast/{coords}', self.forecast)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, '127.0.0.1', 0)
+        await site.start()
+        port = self._runner.addresses[0][1]
+        return f'http://127.0.0.1:{port}'
+
+    def close(self):
+        asyncio.run_coroutine_threadsafe(
+            self._runner.cleanup(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+
+    def _value(self, coords):
+        lat, lon = map(float, coords.split(','))
+        return POINTS[(lon, lat)]
+
+    async def points(self, request):
+        coords = request.match_info['coords']
+        self.requests[request.path] += 1
+        if self._value(coords) == 'outside':
+            raise web.HTTPNotFound()
+
+        return web.json_response(
+            {'properties': {'forecast': f'{self.url}/forecast/{coords}'}})
+
+    async def forecast(self, request):
+        coords = request.match_info['coords']
+        self.requests[request.path] += 1
+        if coords in FLAKY and self.requests[request.path] == 1:
+            raise web.HTTPServiceUnavailable()
+
+        return web.json_response({'properties': {'elevation': {
+            'unitCode': 'wmoUnit:m', 'value': self._value(coords)}}})
+
+
+@pytest.fixture
+def api():
+    api = StandInAPI()
+    try:
+        yield api
+    finally:
+        api.close()
+
+
+def lookup(api, cache_path):
+    lon, lat = np.array(list(POINTS)).T
+    x = np.arange(len(POINTS))
+    return elevation.get_elevations(
+        x, x + 100, lon, lat, api_url=api.url, rate=100,
+        cache_path=cache_path)
+
+
+def test_get_elevations(api, tmp_path):
+    retries = metrics.to_dict()['counters'].get('api_retries', 0)
+    ele = lookup(api, tmp_path / 'elevations.sqlite')
+
+    np.testing.assert_array_equal(ele, [1600.5, 2400, np.nan, np.nan])
+    # The 503 was retried
+    assert metrics.to_dict()['counters']['api_retries'] == retries + 1
+    assert api.requests['/forecast/40.0000,-105.0000'] == 2
+
+
+def test_second_run_served_from_cache(api, tmp_path):
+    cache_path = tmp_path / 'elevations.sqlite'
+    first = lookup(api, cache_path)
+    n_requests = sum(api.requests.values())
+
+    second = lookup(api, cache_path)
+    np.testing.assert_array_equal(second, first)
+    # Points outside the US and null elevations are cached as missing too
+    assert sum(api.requests.values()) == n_requests
@@ -0,0 +1,109 @@
+import functools
+import importlib
+import tarfile
+import threading
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+import geopandas as gpd
+import pandas as pd
+import pytest
+from click.testing import CliRunner
+
+import jobs
+import make_fixtures
+import schema
+from writer import PartitionedWriter
+
+# import is a keyword, so the module can't be imported with a statement
+import_ = importlib.import_module('import')
+
+TARBALL = 'NDFD_20170101.tar'
+
+
+@pytest.fixture(scope='module')
+def fixtures_dir(tmp_path_factory):
+    """Small synthetic tarball with several forecasts per valid time
+    """
+    out_dir = tmp_path_factory.mktemp('fixtures')
+    result = CliRunner().invoke(make_fixtures.main, [
+        '-o', str(out_dir), '--elements', 'YEU', '--hours', '2',
+        '--valid-times', '2', '--cells', '200'])
+    assert result.exit_code == 0, result.output
+    return out_dir
+
+
+@pytest.fixture
+def server_url(fixtures_dir):
+    """Url of a local HTTP server serving the fixtures directory
+    """
+    handler = functools.partial(
+        QuietHandler, directory=str(fixtures_dir))
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f'http://127.0.0.1:{server.server_port}'
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+def read_rows(data_dir):
+    """All raw rows of data directory, sorted
+    """
+    paths = sorted(data_dir.glob('element=*/**/*.parquet'))
+    df = pd.concat([pd.read_parquet(p) for p in paths], ignore_index=True)
+    return df.sort_values(schema.SORT_COLUMNS, ignore_index=True)
+
+
+def import_urls(urls, grid, data_dir, **kwargs):
+    job_catalog = jobs.JobCatalog(data_dir / jobs.DEFAULT_NAME)
+    job_catalog.add_tarballs(urls)
+    try:
+        with PartitionedWriter(
+                data_dir, on_flush=job_catalog.flushed) as writer:
+            import_.import_tar_urls(
+                urls, grid=grid, writer=writer, workers=1, prefetch=0,
+                disk_budget=None, download_dir=None, vsitar=False,
+                job_catalog=job_catalog, **kwargs)
+        return job_catalog.conn.execute(
+            'SELECT tarball, state FROM tarballs').fetchall()
+    finally:
+        job_catalog.close()
+
+
+def test_stream_matches_local_import(fixtures_dir, server_url, tmp_path):
+    grid = gpd.read_file(fixtures_dir / 'grid.geojson')
+
+    local_dir = tmp_path / 'local'
+    with PartitionedWriter(local_dir) as writer, \
+            tarfile.open(fixtures_dir / TARBALL) as tf:
+        import_.import_tarfile(tf=tf, grid=grid, writer=writer)
+
+    stream_dir = tmp_path / 'stream'
+    url = f'{server_url}/{TARBALL}'
+    states = import_urls(
+        [url], grid, stream_dir, stream=True, latest_only=False)
+    assert states == [(url, 'written')]
+
+    expected = read_rows(local_dir)
+    assert len(expected) == 4 * len(grid)
+    pd.testing.assert_frame_equal(read_rows(stream_dir), expected)
+
+
+def test_failed_download_is_recorded(fixtures_dir, server_url, tmp_path):
+    grid = gpd.read_file(fixtures_dir / 'grid.geojson')
+    missing = f'{server_url}/missing.tar'
+    url = f'{server_url}/{TARBALL}'
+    states = import_urls(
+        [missing, url], grid, tmp_path, stream=False, latest_only=True)
+
+    assert dict(states) == {missing: 'failed', url: 'written'}
+    # Forecasts made at hours 0 and 1 for 1 and 2 hours ahead overlap at hour
+    # 2, and only the newest forecast of each valid time is imported
+    assert len(read_rows(tmp_path)) == 3 * len(grid)
@@ -0,0 +1,105 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import schema
+from stats import HISTOGRAM_BINS, N_BINS, CellIndex, Histogram, Moments
+
+CELLS = [1000, 2000, 3000]
+
+
+def temperatures(n, seed=0):
+    """Hourly-like temperatures in K for CELLS over a year, as float32
+    """
+    rng = np.random.default_rng(seed)
+    cells = rng.choice(CELLS, size=n).astype(np.int32)
+    start = schema.to_epoch_minutes(np.array(['2017-01-01'], 'datetime64[m]'))
+    minutes = start[0] + rng.integers(0, 365 * 24 * 60, size=n)
+    vals = rng.normal(280, 10, size=n).astype(np.float32)
+    return cells, minutes.astype(np.int32), vals
+
+
+def histogram_of(cells, minutes, vals, bins):
+    cell_index = CellIndex(CELLS)
+    hist = Histogram(cell_index.cells, *bins)
+    hist.update(cell_index.bin_index(cells, minutes), vals)
+    return hist, cell_index
+
+
+@pytest.mark.parametrize('q', [.01, .1, .5, .9, .99])
+def test_quantile_within_bin_width(q):
+    cells, minutes, vals = temperatures(500_000)
+    bins = HISTOGRAM_BINS['YE']
+    hist, cell_index = histogram_of(cells, minutes, vals, bins)
+    estimate = hist.quantile(q)
+
+    df = pd.DataFrame({
+        'idx': cell_index.bin_index(cells, minutes),
+        'vals': vals.astype(np.float64)})
+    for idx, group in df.groupby('idx')['vals']:
+        exact = group.quantile(q)
+        i, j = divmod(idx, N_BINS)
+        assert abs(estimate[i, j] - exact) <= bins[2], (idx, exact)
+
+
+def test_quantile_empty_is_nan():
+    hist = Histogram(CELLS, *HISTOGRAM_BINS['YE'])
+    assert np.isnan(hist.quantile(.5)).all()
+
+
+def test_exceedance_exact_at_bin_edges():
+    rng = np.random.default_rng(1)
+    n = 100_000
+    cells = rng.choice(CELLS, size=n).astype(np.int32)
+    minutes = np.full(n, 25_000_000, dtype=np.int32)
+    # Precipitation comes in multiples of 0.01 in, i.e. bin edges, and is
+    # rounded to float32, sometimes just below the edge
+    hundredths = rng.geometric(.2, size=n) - 1
+    vals = (hundredths * .254).astype(np.float32)
+
+    hist, cell_index = histogram_of(cells, minutes, vals, HISTOGRAM_BINS['YI'])
+    j = cell_index.bin_index(cells[:1], minutes[:1])[0] % N_BINS
+    for edge in [0, 1, 10, 25, 50]:
+        exceed = hist.exceedance(edge * .254)
+        for i, cell in enumerate(cell_index.cells):
+            expected = (hundredths[cells == cell] >= edge).mean()
+            assert exceed[i, j] == pytest.approx(expected, abs=1e-12)
+
+
+def test_merge_equals_single_pass():
+    cells, minutes, vals = temperatures(200_000, seed=2)
+    cell_index = CellIndex(CELLS)
+    index = cell_index.bin_index(cells, minutes)
+    bins = HISTOGRAM_BINS['YE']
+
+    whole = Histogram(cell_index.cells, *bins)
+    whole.update(index, vals)
+    moments = Moments(cell_index.cells)
+    moments.update(index, vals)
+
+    merged = Histogram(cell_index.cells, *bins)
+    merged_moments = Moments(cell_index.cells)
+    for part in np.array_split(np.arange(len(vals)), 5):
+        hist = Histogram(cell_index.cells, *bins)
+        hist.update(index[part], vals[part])
+        merged.merge(hist)
+        part_moments = Moments(cell_index.cells)
+        part_moments.update(index[part], vals[part])
+        merged_moments.merge(part_moments)
+
+    np.testing.assert_array_equal(merged.counts, whole.counts)
+    np.testing.assert_array_equal(merged.quantile(.5), whole.quantile(.5))
+    np.testing.assert_array_equal(merged_moments.count, moments.count)
+    np.testing.assert_allclose(merged_moments.mean, moments.mean)
+    np.testing.assert_allclose(merged_moments.std, moments.std)
+
+
+def test_save_load(tmp_path):
+    cells, minutes, vals = temperatures(10_000, seed=3)
+    hist, _ = histogram_of(cells, minutes, vals, HISTOGRAM_BINS['YE'])
+    hist.save(tmp_path / 'yeu.histogram.npz')
+
+    loaded = Histogram.load(tmp_path / 'yeu.histogram.npz')
+    np.testing.assert_array_equal(loaded.cells, hist.cells)
+    np.testing.assert_array_equal(loaded.counts, hist.counts)
+    assert loaded.n_bins == hist.n_bins